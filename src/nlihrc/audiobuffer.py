@@ -0,0 +1,84 @@
+"""Preallocated audio buffers"""
+import numpy as np
+
+
+class UtteranceBuffer:
+    """Growable byte buffer, the allocation is reused between utterances"""
+
+    def __init__(self, size: int) -> None:
+        """Initialize buffer with initial size in bytes"""
+        self.buffer = np.zeros(size, dtype=np.uint8)
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def write(self, data) -> None:
+        """Append bytes (or uint8 array) to the end of buffer"""
+        src = np.frombuffer(data, dtype=np.uint8)
+        end = self.length + len(src)
+        if end > len(self.buffer):
+            # Grow geometrically so appending stays amortized O(1)
+            grown = np.zeros(max(end, 2 * len(self.buffer)), dtype=np.uint8)
+            grown[:self.length] = self.buffer[:self.length]
+            self.buffer = grown
+        self.buffer[self.length:end] = src
+        self.length = end
+
+    def view(self) -> np.ndarray:
+        """Get view of buffered bytes without copying"""
+        return self.buffer[:self.length]
+
+    def tobytes(self) -> bytes:
+        """Get buffered bytes"""
+        return self.buffer[:self.length].tobytes()
+
+    def clear(self) -> None:
+        """Empty buffer, keeps allocation"""
+        self.length = 0
+
+
+class RingBuffer:
+    """Fixed size byte ring buffer that keeps only the most recent data"""
+
+    def __init__(self, size: int) -> None:
+        """Initialize buffer with capacity in bytes"""
+        self.buffer = np.zeros(size, dtype=np.uint8)
+        self.size = size
+        self.pos = 0
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    def write(self, data) -> None:
+        """Write bytes to buffer, overwriting the oldest data when full"""
+        src = np.frombuffer(data, dtype=np.uint8)
+        if len(src) >= self.size:
+            self.buffer[:] = src[-self.size:]
+            self.pos = 0
+            self.count = self.size
+            return
+        end = self.pos + len(src)
+        if end <= self.size:
+            self.buffer[self.pos:end] = src
+        else:
+            first = self.size - self.pos
+            self.buffer[self.pos:] = src[:first]
+            self.buffer[:end - self.size] = src[first:]
+        self.pos = end % self.size
+        self.count = min(self.size, self.count + len(src))
+
+    def read_into(self, out: UtteranceBuffer) -> None:
+        """Append buffered data from oldest to newest to out"""
+        start = (self.pos - self.count) % self.size
+        if start + self.count <= self.size:
+            out.write(self.buffer[start:start + self.count])
+        else:
+            out.write(self.buffer[start:])
+            out.write(self.buffer[:self.pos])
+
+    def clear(self) -> None:
+        """Empty buffer"""
+        self.pos = 0
+        self.count = 0
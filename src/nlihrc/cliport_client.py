@@ -1,22 +1,116 @@
 """Client side for CLIPORT"""
+import itertools
 import json
+import threading
+import time
 import rospy
 from std_msgs.msg import String
 
 class CliportClient:
 
-    def __init__(self) -> None:
-        
-        self.pub = rospy.Publisher("/cliport/in", String, queue_size=3)
-        self.sub = rospy.Subscriber("/cliport/out", String, self.sub_callback)
+    def __init__(self, with_ids=False) -> None:
+        """Initialize client. With with_ids requests are sent as JSON {"id", "text"} and the server must echo the id
+        in its reply, otherwise the plain sentence is sent and the first reply after it is taken. Without ids a reply
+        that arrives while no request is waiting is dropped, and so is the first reply after a request timed out or
+        was cancelled, since it is most likely the late reply to that request."""
+        self.with_ids = with_ids
+        self.cond = threading.Condition()
+        self.ids = itertools.count()
+        # Id of the request waiting for a reply
+        self.pending_id = None
+        self.sent_at = 0.0
+        # Without ids: a timed out or cancelled request may still get a late reply
+        self.orphaned = False
+        # Without ids: a reply was dropped as late while the current request was waiting
+        self.discarded = False
 
         self.data = None
+        self.requests = 0
+        self.timeouts = 0
+        self.cancelled = 0
+        self.stale = 0
+        # Running reply latency totals, kept bounded for long sessions
+        self.replies = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
 
+        self.pub = rospy.Publisher("/cliport/in", String, queue_size=3)
+        self.sub = rospy.Subscriber("/cliport/out", String, self.sub_callback)
 
     def sub_callback(self, msg):
-        self.data = json.loads(msg.data)
-        print(self.data)
-    
+        try:
+            data = json.loads(msg.data)
+            reply_id = str(data.get('id')) if self.with_ids else None
+        except (ValueError, AttributeError):
+            with self.cond:
+                self.stale += 1
+            rospy.logwarn(f"Ignoring malformed CLIPORT reply {msg.data!r}")
+            return
+        with self.cond:
+            if not self.with_ids and self.orphaned:
+                # Late reply to a request that already timed out or was cancelled
+                self.orphaned = False
+                self.discarded = self.pending_id is not None
+                stale = True
+            else:
+                stale = self.pending_id is None or (self.with_ids and reply_id != self.pending_id)
+            if stale:
+                self.stale += 1
+                rospy.logwarn(f"Ignoring stale CLIPORT reply {data}")
+                return
+            self.data = data
+            self.pending_id = None
+            latency = time.monotonic() - self.sent_at
+            self.replies += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            self.cond.notify_all()
+        rospy.loginfo(f"CLIPORT reply {data}")
+
     def publish(self, sentence):
         """Send language input to server"""
-        self.pub.publish(sentence)
+        if self.with_ids:
+            self.pub.publish(json.dumps({"id": self.pending_id, "text": sentence}))
+        else:
+            self.pub.publish(sentence)
+
+    def request(self, sentence, timeout, cancel=None):
+        """Send language input and wait for the matching reply. Returns None if it did not arrive in timeout s or
+        if cancel event was set, wake() must be called after setting cancel to end the wait right away"""
+        with self.cond:
+            self.data = None
+            self.pending_id = str(next(self.ids))
+            self.sent_at = time.monotonic()
+            self.discarded = False
+            self.requests += 1
+            self.publish(sentence)
+
+            def cancelled():
+                return cancel is not None and cancel.is_set()
+
+            if not self.cond.wait_for(lambda: self.data is not None or cancelled(), timeout) or self.data is None:
+                # Its late reply is dropped as stale. If a reply was already dropped while waiting it was most likely
+                # this one (the earlier request never got a reply), so the next reply is taken again.
+                self.pending_id = None
+                self.orphaned = not self.with_ids and not self.discarded
+                if cancelled():
+                    self.cancelled += 1
+                else:
+                    self.timeouts += 1
+                return None
+            data = self.data
+            self.data = None
+            return data
+
+    def wake(self):
+        """Wake up a waiting request so it checks its cancel event"""
+        with self.cond:
+            self.cond.notify_all()
+
+    def stats(self):
+        """Get request counters and reply latency in seconds"""
+        with self.cond:
+            return {"requests": self.requests, "timeouts": self.timeouts, "cancelled": self.cancelled,
+                    "stale": self.stale,
+                    "latency_mean": self.latency_sum / self.replies if self.replies > 0 else 0.0,
+                    "latency_max": self.latency_max}
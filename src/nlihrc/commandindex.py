@@ -0,0 +1,73 @@
+"""Exact match lookup from in-grammar sentences to commands"""
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from nlihrc.misc import CLIPORT_CMDS, Command
+
+# Words that are mapped to the word used in the command names
+SYNONYMS = {
+    "forward": "front",
+    "forwards": "front",
+    "backward": "back",
+    "backwards": "back",
+    "upward": "up",
+    "upwards": "up",
+    "downward": "down",
+    "downwards": "down",
+    "gripper": "tool",
+}
+
+# Words that do not change the meaning of a command
+FILLERS = {"the", "please"}
+
+
+def normalize_tokens(sentence: str) -> Tuple[str, ...]:
+    """Split sentence into lowercase tokens with synonyms replaced and filler words dropped"""
+    return tuple(SYNONYMS.get(token, token) for token in sentence.lower().split() if token not in FILLERS)
+
+
+def command_phrases(extra: Optional[Iterable[Tuple[str, Command]]] = None) -> List[Tuple[str, Command]]:
+    """Get (sentence, command) pairs of command names, CLIPORT phrases and extra phrases grouped in Command order.
+
+    A sentence that normalizes like an earlier one is left out, the earlier command wins.
+    """
+    pairs = [(member.name.lower().replace('_', ' '), member) for member in Command]
+    # CLIPORT phrases are dispatched by position, see CommandGenerator
+    first = Command.PUT_WHITE_BOX_IN_BROWN_BOX.value
+    pairs.extend((phrase, Command(first + idx)) for idx, phrase in enumerate(CLIPORT_CMDS))
+    pairs.extend(extra or [])
+    seen = set()
+    grouped: Dict[Command, List[str]] = {member: [] for member in Command}
+    for sentence, cmd in pairs:
+        tokens = normalize_tokens(sentence)
+        if tokens not in seen:
+            seen.add(tokens)
+            grouped[cmd].append(sentence)
+    return [(sentence, cmd) for cmd, sentences in grouped.items() for sentence in sentences]
+
+
+class CommandIndex:
+    """Hash index from normalized token sequences to commands, built from command names and CLIPORT phrases"""
+
+    def __init__(self, extra: Optional[Iterable[Tuple[str, Command]]] = None) -> None:
+        """Build index, extra (sentence, command) pairs are added after the built-in phrases"""
+        self.table: Dict[Tuple[str, ...], Command] = {}
+        for sentence, cmd in command_phrases(extra):
+            self.add(sentence, cmd)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.table)
+
+    def add(self, sentence: str, cmd: Command) -> None:
+        """Add sentence, the first command added for a sentence is kept"""
+        self.table.setdefault(normalize_tokens(sentence), cmd)
+
+    def lookup(self, sentence: str) -> Optional[Command]:
+        """Get command for an in-grammar sentence or None"""
+        cmd = self.table.get(normalize_tokens(sentence))
+        if cmd is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return cmd
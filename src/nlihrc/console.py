@@ -7,7 +7,8 @@ from pathlib import Path
 import click
 import toml
 from nlihrc import __version__
-from nlihrc.main import main_speech, main_robot, main_text, main_app
+
+# NOTE: nlihrc.main is imported inside the subcommands so --version and help do not load ROS or any model stack
 
 
 @click.group()
@@ -27,6 +28,8 @@ def app(ctx):
     """Run full app server"""
     config = ctx.obj['CONFIG']
     click.echo("Running app server...")
+    from nlihrc.main import main_app  # pylint: disable=C0415
+
     main_app(config)
 
 
@@ -36,6 +39,8 @@ def speech(ctx):
     """Run speech server"""
     config = ctx.obj['CONFIG']
     click.echo("Running Speech only server...")
+    from nlihrc.main import main_speech  # pylint: disable=C0415
+
     main_speech(config)
 
 
@@ -45,6 +50,7 @@ def robot(ctx):
     """Run robot server"""
     config = ctx.obj['CONFIG']
     click.echo("Running Robot only server...")
+    from nlihrc.main import main_robot  # pylint: disable=C0415
 
     main_robot(config)
 
@@ -55,5 +61,42 @@ def text(ctx):
     """Run text classification server"""
     config = ctx.obj['CONFIG']
     click.echo("Running text classification only server...")
+    from nlihrc.main import main_text  # pylint: disable=C0415
 
     main_text(config)
+
+
+@nlihrc_cli.command()
+@click.pass_context
+def distill(ctx):
+    """Build word/bigram embedding table for the lite text backend (no ROS needed)"""
+    config = ctx.obj['CONFIG']
+    click.echo("Encoding speech recognizer vocabulary...")
+    from nlihrc.text import build_lite_table  # pylint: disable=C0415
+
+    count = build_lite_table(config)
+    click.echo(f"Saved {count} entries to {config['text']['litetable']}")
+
+
+@nlihrc_cli.command()
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True, file_okay=True, dir_okay=False))
+@click.option("--realtime/--fast", default=False, help="Stream audio at real-time pace or as fast as possible")
+@click.pass_context
+def replay(ctx, paths, realtime):
+    """Replay recorded WAV/raw int16 files through speech recognizer and report timings (no ROS needed)"""
+    config = ctx.obj['CONFIG']
+    click.echo(f"Replaying {len(paths)} file(s) {'at real-time pace' if realtime else 'as fast as possible'}...")
+    from nlihrc.replay import run_replay  # pylint: disable=C0415
+
+    def on_text(words, number, deleted):
+        click.echo(f"Recognized words: {' '.join(words)}, number: {number}, omitted: {' '.join(deleted)}")
+
+    results = run_replay(config, paths, realtime, on_text)
+    click.echo(f"Audio {results['audio_s']:.2f} s processed in {results['wall_s']:.2f} s, "
+               f"real-time factor {results['rtf']:.3f}")
+    click.echo(f"VAD per chunk: mean {results['vad_ms_mean']:.3f} ms, max {results['vad_ms_max']:.3f} ms "
+               f"({results['chunks']} chunks)")
+    click.echo(f"Decode per utterance: mean {results['decode_ms_mean']:.1f} ms, max {results['decode_ms_max']:.1f} ms, "
+               f"final step mean {results['final_decode_ms_mean']:.1f} ms ({results['utterances']} utterances)")
+    click.echo(f"End of speech to text latency: mean {results['latency_ms_mean']:.1f} ms, "
+               f"max {results['latency_ms_max']:.1f} ms")
@@ -0,0 +1,229 @@
+"""Sentence embedding backends for the text classifier"""
+import hashlib
+import os
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+class SentenceTransformerBackend:
+    """Embeddings from sentence_transformers, needs torch"""
+
+    def __init__(self, model_name: str = 'sentence-transformers/all-MiniLM-L6-v2') -> None:
+        import sentence_transformers  # pylint: disable=C0415
+
+        self.model_id = model_name
+        self.model = sentence_transformers.SentenceTransformer(model_name)
+
+    def encode(self, sentences: Sequence[str]) -> np.ndarray:
+        """Get (len(sentences), dim) float32 embeddings"""
+        return np.asarray(self.model.encode(list(sentences), convert_to_tensor=False), dtype=np.float32)
+
+
+class WordPieceTokenizer:
+    """Uncased BERT tokenizer (basic tokenization followed by greedy longest match WordPiece)"""
+
+    def __init__(self, vocab_path: str, max_length: int = 256) -> None:
+        """Load vocab.txt with one token per line, line number is the token id"""
+        with open(vocab_path, encoding='utf-8') as vocab_file:
+            self.vocab: Dict[str, int] = {line.rstrip('\n'): idx for idx, line in enumerate(vocab_file)}
+        self.max_length = max_length
+        self.cls_id = self.vocab['[CLS]']
+        self.sep_id = self.vocab['[SEP]']
+        self.pad_id = self.vocab['[PAD]']
+        self.unk_id = self.vocab['[UNK]']
+
+    @staticmethod
+    def basic_tokens(text: str) -> List[str]:
+        """Lowercase, strip accents and split on whitespace and punctuation"""
+        text = unicodedata.normalize('NFD', text.lower())
+        tokens: List[str] = []
+        word: List[str] = []
+        for char in text:
+            category = unicodedata.category(char)
+            if category == 'Mn' or (category.startswith('C') and not char.isspace()):
+                continue
+            if char.isspace() or category.startswith('P') or char in '$+<=>^`|~':
+                if len(word) > 0:
+                    tokens.append(''.join(word))
+                    word = []
+                if not char.isspace():
+                    tokens.append(char)
+            else:
+                word.append(char)
+        if len(word) > 0:
+            tokens.append(''.join(word))
+        return tokens
+
+    def word_ids(self, word: str) -> List[int]:
+        """Split word into known sub-word ids"""
+        if len(word) > 100:
+            return [self.unk_id]
+        ids = []
+        start = 0
+        while start < len(word):
+            end = len(word)
+            while end > start:
+                piece = word[start:end] if start == 0 else '##' + word[start:end]
+                if piece in self.vocab:
+                    ids.append(self.vocab[piece])
+                    break
+                end -= 1
+            if end == start:
+                return [self.unk_id]
+            start = end
+        return ids
+
+    def encode(self, text: str) -> List[int]:
+        """Get token ids with [CLS] and [SEP], truncated to max_length"""
+        ids = [idx for word in self.basic_tokens(text) for idx in self.word_ids(word)]
+        return [self.cls_id] + ids[:self.max_length - 2] + [self.sep_id]
+
+    def __call__(self, sentences: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """Get padded (batch, length) int64 input ids and attention mask"""
+        encoded = [self.encode(sentence) for sentence in sentences]
+        length = max(len(ids) for ids in encoded)
+        input_ids = np.full((len(encoded), length), self.pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(encoded), length), dtype=np.int64)
+        for row, ids in enumerate(encoded):
+            input_ids[row, :len(ids)] = ids
+            attention_mask[row, :len(ids)] = 1
+        return input_ids, attention_mask
+
+
+class OnnxBackend:
+    """MiniLM sentence embeddings with onnxruntime, e.g. an int8 quantized export of all-MiniLM-L6-v2.
+
+    model_dir holds the graph and the vocab.txt of its tokenizer. Token embeddings are mean pooled over the
+    attention mask and L2 normalized like the sentence_transformers pipeline of the same model.
+    """
+
+    def __init__(self, model_dir: str, model_file: str = 'model_qint8.onnx', intra_op_threads: int = 1,
+                 inter_op_threads: int = 1) -> None:
+        for name in [model_file, 'vocab.txt']:
+            if not Path(model_dir, name).is_file():
+                raise FileNotFoundError(f"ONNX text model file {Path(model_dir, name)} not found, export the model "
+                                        "as described in README.rst or use backend = \"sentence_transformers\"")
+        stat = Path(model_dir, model_file).stat()
+        # Graph name, size and modification time identify the model version for cached embeddings
+        self.model_id = f"onnx:{model_file}:{stat.st_size}:{stat.st_mtime_ns}"
+        import onnxruntime  # pylint: disable=C0415
+
+        self.tokenizer = WordPieceTokenizer(str(Path(model_dir, 'vocab.txt')))
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(str(Path(model_dir, model_file)), sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def encode(self, sentences: Sequence[str]) -> np.ndarray:
+        """Get (len(sentences), dim) float32 embeddings"""
+        input_ids, attention_mask = self.tokenizer(sentences)
+        feed = {'input_ids': input_ids, 'attention_mask': attention_mask,
+                'token_type_ids': np.zeros_like(input_ids)}
+        output = self.session.run(None, {name: value for name, value in feed.items() if name in self.input_names})[0]
+        if output.ndim == 3:
+            mask = attention_mask[:, :, None].astype(np.float32)
+            output = (output * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(output, axis=1, keepdims=True)
+        return (output / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class LiteBackend:
+    """Sentence embeddings composed from a static table of word and bigram vectors, no transformer runtime.
+
+    The table covers the closed vocabulary of the speech recognizer (see build_lite_table). A sentence embedding
+    is the normalized mean of the vectors of its known words and adjacent word pairs.
+    """
+
+    def __init__(self, table_path: str) -> None:
+        """Load table saved by save_lite_table"""
+        if not Path(table_path).is_file():
+            raise FileNotFoundError(f"Lite text table {table_path} not found, build it with the distill command")
+        stat = Path(table_path).stat()
+        self.model_id = f"lite:{Path(table_path).name}:{stat.st_size}:{stat.st_mtime_ns}"
+        with np.load(table_path) as table:
+            self.vectors = table['vectors']
+            self.ids: Dict[str, int] = {str(token): idx for idx, token in enumerate(table['tokens'])}
+
+    def encode(self, sentences: Sequence[str]) -> np.ndarray:
+        """Get (len(sentences), dim) float32 embeddings, sentences without known words get zero vectors"""
+        out = np.zeros((len(sentences), self.vectors.shape[1]), dtype=np.float32)
+        for row, sentence in enumerate(sentences):
+            words = sentence.lower().split()
+            grams = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+            ids = [self.ids[gram] for gram in grams if gram in self.ids]
+            if len(ids) > 0:
+                pooled = self.vectors[ids].mean(axis=0, dtype=np.float32)
+                out[row] = pooled / max(np.linalg.norm(pooled), 1e-12)
+        return out
+
+
+def lite_vocabulary(phrases: Sequence[str]) -> List[str]:
+    """Get words and adjacent word pairs of phrases"""
+    grams: Dict[str, None] = {}
+    for phrase in phrases:
+        words = phrase.lower().split()
+        grams.update((word, None) for word in words)
+        grams.update((f"{first} {second}", None) for first, second in zip(words, words[1:]))
+    return list(grams)
+
+
+def save_lite_table(backend, phrases: Sequence[str], path: str) -> int:
+    """Encode vocabulary of phrases with backend and save it as float16 table for LiteBackend, returns its size"""
+    tokens = lite_vocabulary(phrases)
+    vectors = backend.encode(tokens).astype(np.float16)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as table_file:
+        np.savez(table_file, tokens=np.array(tokens), vectors=vectors)
+    return len(tokens)
+
+
+def cache_key(model_id: str, sentences: Sequence[str]) -> str:
+    """Hash of model identifier and sentence list"""
+    digest = hashlib.sha256(model_id.encode('utf-8'))
+    for sentence in sentences:
+        digest.update(b'\0' + sentence.encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def load_or_encode(backend, sentences: Sequence[str], cache_dir: Optional[str]) -> np.ndarray:
+    """Get embeddings of sentences, memory-mapped from cache_dir if the same model already encoded them.
+
+    Cache files are named by cache_key, so a changed model or sentence list is encoded and saved again.
+    """
+    if cache_dir is None:
+        return backend.encode(sentences)
+    path = Path(cache_dir, f"embeddings-{cache_key(backend.model_id, sentences)}.npy")
+    if path.exists():
+        try:
+            embeddings = np.load(path, mmap_mode='r')
+        except ValueError:
+            embeddings = None
+        if embeddings is not None and embeddings.ndim == 2 and embeddings.shape[0] == len(sentences):
+            return embeddings
+    embeddings = backend.encode(sentences)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first so other processes never map a partially written file
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as tmp_file:
+        np.save(tmp_file, embeddings)
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+def get_backend(config):
+    """Create embedding backend from config"""
+    text_config = config.get('text', {})
+    backend = text_config.get('backend', 'sentence_transformers')
+    if backend == 'lite':
+        return LiteBackend(text_config['litetable'])
+    if backend == 'onnx':
+        return OnnxBackend(text_config['modelpath'], text_config.get('modelfile', 'model_qint8.onnx'),
+                           text_config.get('intraopthreads', 1), text_config.get('interopthreads', 1))
+    return SentenceTransformerBackend(text_config.get('modelname', 'sentence-transformers/all-MiniLM-L6-v2'))
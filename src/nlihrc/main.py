@@ -1,115 +1,235 @@
-"""Main file"""
-from pathlib import Path
-# sentence_transformers might fail to import later if it isn't imported here.
-import sentence_transformers
+"""Main file
 
+Speech (vosk, onnxruntime, sounddevice), text (lite table, onnxruntime or sentence_transformers and torch) and robot
+(moveit) stacks are imported inside the entrypoints that use them, so each node only loads its own dependencies.
+"""
+from pathlib import Path
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 import rospy
 
-from nlihrc.udpclient import UDPReceiver
-from nlihrc.speech import SpeechRecognizer
-from nlihrc.text import TextClassifier
-from nlihrc.robot import CommandGenerator
-from nlihrc.misc import Command
-from nlihrc.microphone import MicReceiver
+from nlihrc.udpclient import UDPReceiver, PooledUDPReceiver
+from nlihrc.misc import Command, CommandMode
+from nlihrc.pipeline import Pipeline
+from nlihrc.scheduler import CommandScheduler
+from nlihrc.textservice import TextService, parse_request
 from std_msgs.msg import String
 
 
-def main_speech(config):
-    """Speech Recognition Server"""
-    rospy.init_node("nlihrc_speech", anonymous=True, log_level=rospy.INFO)
-    # Get config
-    rate = config['speech']['rate']
+def import_text_stack(config):
+    """Import text classifier factory"""
+    if config.get('text', {}).get('backend', 'sentence_transformers') == 'sentence_transformers':
+        # sentence_transformers might fail to import later if it isn't imported before the other stacks.
+        import sentence_transformers  # pylint: disable=C0415,W0611
+    from nlihrc.text import get_classifier  # pylint: disable=C0415
+
+    return get_classifier
+
+
+def get_com_surface(config):
+    """Create audio receiver based on config"""
     chunk = config['speech']['chunk']
-    port = config['network']['port']
-    ip = config['network']['ip']
-    modelpath = config['speech']['modelpath']
-    uselocal = config['speech']['uselocal']
+    queue_size = config.get('pipeline', {}).get('queuesize', 16)
+    if config['speech']['uselocal']:
+        from nlihrc.microphone import MicReceiver  # pylint: disable=C0415
 
-    if uselocal:
         # raw speech data receiver
-        com_surface = MicReceiver(chunk)
+        return MicReceiver(chunk, queue_size)
+    network = config['network']
+    if network.get('recvpool', False):
+        # UDP Receiver reading into preallocated buffers, optionally reordering sequence numbered datagrams
+        pool_size = queue_size + config.get('pipeline', {}).get('vadbatch', 8) + 2
+        return PooledUDPReceiver(chunk, network['ip'], network['port'], queue_size, is_multisession(config),
+                                 network.get('seqheader', False), network.get('jitterdepth', 4), pool_size,
+                                 network.get('sendertimeout', 60.0))
+    # UDP Receiver (Handles Android App comm.)
+    return UDPReceiver(chunk, network['ip'], network['port'], queue_size, with_address=is_multisession(config))
+
+
+def is_multisession(config):
+    """Check if every UDP client should get its own recognizer session"""
+    return not config['speech']['uselocal'] and config['speech'].get('multisession', False)
+
+
+def close_com_surface(com_surface, uselocal):
+    """Stop audio receiver and drop any buffered audio"""
+    if uselocal:
+        rospy.loginfo("Closing mic")
+        com_surface.stop()
     else:
-        # UDP Receiver (Handles Android App comm.)
-        com_surface = UDPReceiver(chunk, ip, port)
+        com_surface.stop()
+        com_surface.join()
+        if isinstance(com_surface, PooledUDPReceiver):
+            rospy.loginfo(f"UDP packet stats: {com_surface.stats()}")
+    while not com_surface.q.empty():
+        com_surface.q.get()
+
+
+def log_recognized(words, number, deleted, source=None):
+    """Log speech recognition output. Returns False if nothing was recognized"""
+    if len(words) == 0 and len(deleted) == 0:
+        return False
+    prefix = "" if source is None else f"[{source[0]}:{source[1]}] "
+    rospy.loginfo(f'{prefix}Recognized words: {" ".join(words)}')
+    if len(deleted) > 0:
+        rospy.loginfo(f'Omitted words: {" ".join(deleted)}')
+    if number is not None:
+        rospy.loginfo(f'Recognized number: {number}')
+    return True
 
-    rec = SpeechRecognizer(modelpath, rate, chunk)
 
-    # Start udp thread
+def log_partial(rec):
+    """Log partial result of an utterance that is still being decoded"""
+    if rec.partial != "":
+        rospy.logdebug(f"Partial words: {rec.partial}")
+
+
+def log_stage_error(name, error):
+    """Pipeline stage error callback"""
+    rospy.logerr(f"Pipeline stage {name} failed: {error!r}")
+
+
+def get_recognizer(config):
+    """Create speech recognizer from config"""
+    # pylint: disable=C0415
+    from nlihrc.speech import MultiSpeechRecognizer, get_vad, get_recognizer as get_single_recognizer
+
+    if is_multisession(config):
+        # Speech Recognizer per UDP client, VAD runs once per tick for all clients
+        return MultiSpeechRecognizer(config['speech']['modelpath'], config['speech']['rate'],
+                                     config['speech']['chunk'], config['speech'].get('streaming', False),
+                                     config['speech'].get('sessiontimeout', 60.0), get_vad(config, batched=True),
+                                     config['speech'].get('earlyendpoint', False),
+                                     config['speech'].get('endpointguard', 0.3))
+    # Speech Recognizer (Handles speech to text)
+    return get_single_recognizer(config)
+
+
+def add_speech_stages(pipeline, config, rec):
+    """Add VAD and ASR stages to pipeline. ASR stage forwards (words, number) of recognized utterances"""
+    from nlihrc.speech import MultiSpeechRecognizer  # pylint: disable=C0415
+
+    if isinstance(rec, MultiSpeechRecognizer):
+        def asr(item):
+            addr, segment = item
+            words, number, deleted = rec.transcribe(addr, segment)
+            session = rec.sessions.get(addr)
+            if session is not None:
+                log_partial(session)
+            if not log_recognized(words, number, deleted, addr):
+                return None
+            return words, number
+
+        pipeline.add_stage("vad", rec.detect, config.get('pipeline', {}).get('vadbatch', 8))
+    else:
+        def asr(segment):
+            words, number, deleted = rec.transcribe(*segment)
+            log_partial(rec)
+            if not log_recognized(words, number, deleted):
+                return None
+            return words, number
+
+        pipeline.add_stage("vad", rec.detect)
+    pipeline.add_stage("asr", asr)
+
+
+def timed_init(timings, name, func, *args):
+    """Construct component and record how long it took"""
+    t1 = time.time()
+    component = func(*args)
+    timings[name] = time.time() - t1
+    rospy.loginfo(f"{name} initialized in {timings[name]:.2f} s")
+    return component
+
+
+def run_pipeline(pipeline, com_surface, uselocal, vad=None, textclassifier=None):
+    """Start audio receiver and pipeline, block until ROS shutdown"""
+    rospy.on_shutdown(pipeline.stop)
+    pipeline.start()
+    # Start udp/local thread
     com_surface.start()
+    try:
+        pipeline.wait()
+    except KeyboardInterrupt:
+        pipeline.stop()
+    finally:
+        close_com_surface(com_surface, uselocal)
+        rospy.loginfo(f"Pipeline stats: {pipeline.stats()}")
+        if textclassifier is not None:
+            index = textclassifier.index
+            rospy.loginfo(f"Classifier exact index hits {index.hits}, misses {index.misses}, "
+                          f"cache stats: {textclassifier.cache.stats()}")
+        if vad is not None:
+            rospy.loginfo(f"Mean VAD time per chunk: {1000 * vad.mean_time():.3f} ms over {vad.calls} chunks")
+
+
+def main_speech(config):
+    """Speech Recognition Server"""
+    rospy.init_node("nlihrc_speech", anonymous=True, log_level=rospy.INFO)
+    # Get config
+    port = config['network']['port']
+    uselocal = config['speech']['uselocal']
+
+    com_surface = get_com_surface(config)
+    rec = get_recognizer(config)
+    pipeline = Pipeline(com_surface.q, config.get('pipeline', {}).get('queuesize', 16), log_stage_error)
+    add_speech_stages(pipeline, config, rec)
 
-    # Main program loop
     if uselocal:
         rospy.loginfo("Mic online")
     else:
         rospy.loginfo(f"Speech server online. Listening at {com_surface.host_ip = }, {port = }")
-    try:
-        while not rospy.is_shutdown():
-            # Get audio data
-            if com_surface.q.empty():
-                continue
-            data = com_surface.q.get()
-            # Speech to text conversion
-            words, number, deleted = rec.speech_to_text(data)
-            if len(words) > 0 or len(deleted) > 0:
-                rospy.loginfo(f'Recognized words: {" ".join(words)}')
-                if len(deleted) > 0:
-                    rospy.loginfo(f'Omitted words: {" ".join(deleted)}')
-                if number is not None:
-                    rospy.loginfo(f'Recognized number: {number}')
-            else:
-                continue
-    except KeyboardInterrupt:
-        rospy.loginfo("Shutting down speech server")
-    finally:
-        if uselocal:
-            rospy.loginfo("Closing mic")
-            com_surface.stop()
-        else:
-            com_surface.close_thread = True
-            com_surface.join()
-            while not com_surface.q.empty():
-                com_surface.q.get()
+    run_pipeline(pipeline, com_surface, uselocal, rec.vad)
+    rospy.loginfo("Shutting down speech server")
 
 
 class TextSub:
-    def __init__(self) -> None:
+    def __init__(self, service) -> None:
         self.topic = "command"
+        self.service = service
         self.sub = rospy.Subscriber(self.topic, String, self.callback)
-        self.text = None
 
     def callback(self, msg):
-        """Ros subscriber callback"""
+        """Ros subscriber callback, queues every request to the text service"""
         if msg.data != "":
-            self.text = msg.data
-
-    def clear(self):
-        self.text = None
+            request_id, text = parse_request(msg.data)
+            self.service.submit(text, request_id)
 
 
 def main_text(config):
     rospy.init_node("nlihrc_text", anonymous=True, log_level=rospy.INFO)
-    ros_sub = TextSub()
-    textclassifier = TextClassifier()
-    rospy.loginfo(f"Text server online. Listening for String msg at /{ros_sub.topic}")
-    while not rospy.is_shutdown():
-        if ros_sub.text is not None:
-            t1 = time.time()
-            cmd = textclassifier.find_match(ros_sub.text)
-            rospy.loginfo(f"{ros_sub.text = } and classified {cmd = }")
-            rospy.loginfo(f"Time taken: {time.time() - t1:}")
-            ros_sub.clear()
+    get_classifier = import_text_stack(config)
+    text_config = config.get('text', {})
+    textclassifier = get_classifier(config)
+    reply_topic = text_config.get('replytopic', 'command_reply')
+    pub = rospy.Publisher(reply_topic, String, queue_size=text_config.get('queuesize', 64))
+
+    def publish(reply):
+        pub.publish(String(json.dumps(reply)))
+        rospy.loginfo(f"Classified {reply}")
+
+    service = TextService(textclassifier, publish, text_config.get('threshold', 0.7),
+                          text_config.get('queuesize', 64), text_config.get('batchwindow', 0.005),
+                          text_config.get('maxbatch', 32), log_stage_error)
+    service.start()
+    ros_sub = TextSub(service)
+    rospy.loginfo(f"Text server online. Listening for String msg at /{ros_sub.topic}, replying at /{reply_topic}")
+    rospy.spin()
+    service.stop()
+    service.join()
+    rospy.loginfo(f"Text server stats: {service.stats()}, index hits {textclassifier.index.hits}, "
+                  f"cache {textclassifier.cache.stats()}")
 
 
 class RobotSub:
-    def __init__(self) -> None:
+    def __init__(self, scheduler) -> None:
         self.topic = "command"
+        self.scheduler = scheduler
         self.sub = rospy.Subscriber(self.topic, String, self.callback)
-        self.cmd = None
-        self.number = None
 
     def callback(self, msg):
-        """Ros subscriber callback"""
+        """Ros subscriber callback, queues command to the scheduler (thread-safe, never blocks)"""
         data_items = msg.data.split(',')
         number = None
         cmd_index = None
@@ -123,96 +243,115 @@ class RobotSub:
                 number = int(number)
         cmd = Command(int(cmd_index))
 
-        self.cmd = cmd
-        self.number = number
+        self.scheduler.submit(cmd, number)
+
+
+def get_scheduler(config, cmdgen):
+    """Create command scheduler that runs commands on cmdgen and publishes its status"""
+    topic = config['robot'].get('statustopic', 'robot_status')
+    status_pub = rospy.Publisher(topic, String, queue_size=10)
 
-    def clear(self):
-        self.cmd = None
-        self.number = None
+    def publish_status(status):
+        status_pub.publish(String(json.dumps(status)))
+
+    # Only the newest of back to back jog commands matters while the robot keeps moving in continuous mode.
+    # Jogs run in the mode of the newest queued mode command, or in the current mode if none is queued.
+    def coalesce(queued_mode):
+        if queued_mode is not None:
+            return queued_mode == Command.SET_MODE_CONTINUOUS
+        return cmdgen.mode == CommandMode.CONTINUOUS
+
+    scheduler = CommandScheduler(cmdgen.run, cmdgen.preempt, publish_status, log_command_error, cmdgen.cancel,
+                                 queue_size=config['robot'].get('queuesize', 32), coalesce=coalesce)
+    rospy.loginfo(f"Publishing robot status at /{topic}")
+    return scheduler
+
+
+def log_command_error(name, error):
+    """Command scheduler error callback"""
+    rospy.logerr(f"Command {name} failed: {error!r}")
 
 
 def main_robot(config):
+    from nlihrc.robot import CommandGenerator  # pylint: disable=C0415
+
     rospy.init_node("nlihrc_robot", anonymous=True, log_level=rospy.INFO)
     cmdgen = CommandGenerator(config)
-    ros_sub = RobotSub()
+    scheduler = get_scheduler(config, cmdgen)
+    scheduler.start()
+    ros_sub = RobotSub(scheduler)
     rospy.loginfo(f"Robot server online. Listening for String msg of format 'cmd,number' at /{ros_sub.topic}")
-    while not rospy.is_shutdown():
-        if ros_sub.cmd is not None:
-            cmdgen.run(ros_sub.cmd, ros_sub.number)
-            ros_sub.clear()
+    rospy.spin()
+    scheduler.stop()
+    scheduler.join()
+    rospy.loginfo(f"Scheduler stats: {scheduler.stats()}")
 
 
 def main_app(config):
     """Main app that combines all modules"""
+    get_classifier = import_text_stack(config)
+    from nlihrc.robot import CommandGenerator  # pylint: disable=C0415
+
     rospy.init_node("nlihrc", anonymous=True, log_level=rospy.INFO)
     rospy.loginfo(f"Node initialized")
     # Get config
-    rate = config['speech']['rate']
-    chunk = config['speech']['chunk']
     port = config['network']['port']
-    ip = config['network']['ip']
-    modelpath = config['speech']['modelpath']
     uselocal = config['speech']['uselocal']
     rospy.loginfo(f"config loaded")
-    if uselocal:
-        # raw speech data receiver
-        com_surface = MicReceiver(chunk)
+    com_surface = get_com_surface(config)
+
+    timings = {}
+    t1 = time.time()
+    if config.get('app', {}).get('parallelinit', True):
+        # Load models in worker threads while the manipulator homes in this thread
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            rec_future = executor.submit(timed_init, timings, "Recognizer", get_recognizer, config)
+            text_future = executor.submit(timed_init, timings, "Classifier", get_classifier, config)
+            # Command generator (Handles robot manipulation based on commands)
+            cmdgen = timed_init(timings, "Command generator", CommandGenerator, config)
+            rec = rec_future.result()
+            textclassifier = text_future.result()
     else:
-        # UDP Receiver (Handles Android App comm.)
-        com_surface = UDPReceiver(chunk, ip, port)
+        # Speech Recognizer (Handles speech to text)
+        rec = timed_init(timings, "Recognizer", get_recognizer, config)
+        # Text classififiers (Handles text to command)
+        textclassifier = timed_init(timings, "Classifier", get_classifier, config)
+        # Command generator (Handles robot manipulation based on commands)
+        cmdgen = timed_init(timings, "Command generator", CommandGenerator, config)
+    rospy.loginfo(f"Startup took {time.time() - t1:.2f} s, per component: "
+                  + ", ".join(f"{name} {seconds:.2f} s" for name, seconds in timings.items()))
 
-    # Speech Recognizer (Handles speech to text)
-    rec = SpeechRecognizer(modelpath, rate, chunk)
-    rospy.loginfo(f"Recognizer initialized")
+    threshold = config.get('text', {}).get('threshold', 0.7)
 
-    # Text classififiers (Handles text to command)
-    textclassifier = TextClassifier()
-    rospy.loginfo(f"Classifier initialized")
+    def classify(recognized):
+        # Text to command classification
+        words, number = recognized
+        sentence = ' '.join(words)
+        cmd = textclassifier.find_match(sentence, threshold)
+        if cmd is None:
+            rospy.logwarn(f"Couldn't classify given {sentence = } to any command")
+            return None
+        return cmd, number
 
-    # Command generator (Handles robot manipulation based on commands)
-    cmdgen = CommandGenerator(config)
-    rospy.loginfo(f"Command generator initialized")
+    # Robot commands run in the scheduler so stop/recover can preempt a running sequence
+    scheduler = get_scheduler(config, cmdgen)
+    scheduler.start()
 
-    # Start udp/local thread
-    com_surface.start()
+    def dispatch(command):
+        # Command to robot
+        scheduler.submit(*command)
+
+    # Audio intake runs in com_surface, each following stage in its own worker
+    pipeline = Pipeline(com_surface.q, config.get('pipeline', {}).get('queuesize', 16), log_stage_error)
+    add_speech_stages(pipeline, config, rec)
+    pipeline.add_stage("classify", classify).add_stage("robot", dispatch)
 
-    # Main program loop
     if uselocal:
         rospy.loginfo("Mic online")
     else:
         rospy.loginfo(f"Speech server online. Listening at {com_surface.host_ip = }, {port = }")
-    try:
-        while not rospy.is_shutdown():
-            # Get audio data
-            if com_surface.q.empty():
-                continue
-            data = com_surface.q.get()
-            # Speech to text conversion
-            words, number, deleted = rec.speech_to_text(data)
-            if len(words) > 0 or len(deleted) > 0:
-                rospy.loginfo(f'Recognized words: {" ".join(words)}')
-                if len(deleted) > 0:
-                    rospy.loginfo(f'Omitted words: {" ".join(deleted)}')
-                if number is not None:
-                    rospy.loginfo(f'Recognized number: {number}')
-            else:
-                continue
-            # Text to command classification
-            sentence = ' '.join(words)
-            cmd = textclassifier.find_match(sentence, 0.7)
-            if cmd is None:
-                rospy.logwarn(f"Couldn't classify given {sentence = } to any command")
-                continue
-            # Command to robot
-            cmdgen.run(cmd, number)
-    except KeyboardInterrupt:
-        rospy.loginfo("Shutting down app server")
-    finally:
-        if uselocal:
-            rospy.loginfo("Closing mic")
-            com_surface.stop()
-        else:
-            com_surface.close_thread = True
-            com_surface.join()
-            while not com_surface.q.empty():
-                com_surface.q.get()
+    run_pipeline(pipeline, com_surface, uselocal, rec.vad, textclassifier)
+    scheduler.stop()
+    scheduler.join()
+    rospy.loginfo(f"Scheduler stats: {scheduler.stats()}")
+    rospy.loginfo("Shutting down app server")
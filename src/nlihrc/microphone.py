@@ -3,8 +3,9 @@ import sys
 import sounddevice
 
 class MicReceiver():
-    def __init__(self, buffersize):
-        self.q = queue.Queue()
+    def __init__(self, buffersize, queue_size=0):
+        self.q = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
         self.close_thread = False
         self.rate = 16000
         self.buffersize = buffersize
@@ -18,7 +19,11 @@ class MicReceiver():
     def callback(self, indata, frames, time, status):
         if status:
             print(status, file=sys.stderr)
-        self.q.put(bytes(indata))
+        # Audio callback must never block, drop chunk if consumer is behind
+        try:
+            self.q.put_nowait(bytes(indata))
+        except queue.Full:
+            self.dropped += 1
     
     def start(self):
         self.audiostream.start()
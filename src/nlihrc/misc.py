@@ -1,4 +1,5 @@
 """Utility functions"""
+from collections import OrderedDict
 from enum import Enum, unique
 
 import numpy as np
@@ -27,6 +28,32 @@ CLIPORT_CMDS = [
     "put rocker arm in red box",
 ]
 
+ASR_NUMBERS = ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "zero",
+               "eleven", "twelve", "thirteen", "fourteen", "fifteen", "sixteen", "seventeen", "eighteen",
+               "nineteen", "twenty", "thirty", "forty", "fifty", "sixty", "seventy", "eighty", "ninety",
+               "hundred", "thousand", ]
+
+ASR_UNKNOWN_WORD = "[unk]"
+
+# Phrases the speech recognizer is restricted to
+ASR_GRAMMAR = [
+    # System commands
+    "start", "stop", "robot", "execution", "move", "go", "set mode", "continuous", "model", "step", "size",
+    "tool", "open", "close", "rotate", "save", "home", "position", "load", "place", "the", "recover", "repeat",
+    # Directions
+    "up", "down", "left", "right", "forward", "backward", "front", "back",
+    # numbers
+    *ASR_NUMBERS,
+    "minus", "negative", "once", "twice", "thrice", "times",
+    # cliport
+    *CLIPORT_CMDS,
+    # other
+    "give", "long", "screw", "screws", "push", "rod", "rods", "cap", "piston", "rocker", "arm", "arms", "bolt",
+    "bolts",
+    # unknown
+    ASR_UNKNOWN_WORD]
+
+
 class GoalStatus(Enum):
     PENDING = 0   # The goal has yet to be processed by the action server
     ACTIVE = 1   # The goal is currently being processed by the action server
@@ -103,6 +130,97 @@ class Command(Enum):
     PUT_PUSH_ROD_IN_RED_BOX = 37
     PUT_ROCKER_ARM_IN_RED_BOX = 38
 
+class LRUCache:
+    """Bounded mapping that evicts the least recently used entry, counts hits and misses"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """Get value and mark it as most recently used"""
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Add value, evicting the least recently used one if full"""
+        if self.maxsize <= 0:
+            return
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove value"""
+        return self.data.pop(key, default)
+
+    def clear(self):
+        """Remove all values"""
+        self.data.clear()
+
+    def stats(self):
+        """Get hit/miss counters"""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.data)}
+
+
+class PlanCache:
+    """LRU cache of joint space trajectories keyed by quantized start and goal joint values.
+
+    A cached trajectory is only returned if its first point is within resolution of the actual start state.
+    """
+
+    def __init__(self, maxsize=32, resolution=0.01):
+        """Initialize cache, resolution is in radians"""
+        self.cache = LRUCache(maxsize)
+        self.resolution = resolution
+        self.invalid = 0
+
+    def key(self, start, goal):
+        """Quantize joint values"""
+        return (tuple(np.round(np.asarray(start) / self.resolution).astype(int)),
+                tuple(np.round(np.asarray(goal) / self.resolution).astype(int)))
+
+    def get(self, joint_names, start, goal):
+        """Get trajectory (moveit_msgs RobotTrajectory) for moving from start to goal or None"""
+        key = self.key(start, goal)
+        trajectory = self.cache.get(key)
+        if trajectory is None:
+            return None
+        cached = dict(zip(trajectory.joint_trajectory.joint_names, trajectory.joint_trajectory.points[0].positions))
+        if set(cached) != set(joint_names) or \
+                max(abs(cached[name] - value) for name, value in zip(joint_names, start)) > self.resolution:
+            # Start state drifted since the plan was made
+            self.cache.pop(key)
+            self.cache.hits -= 1
+            self.cache.misses += 1
+            self.invalid += 1
+            return None
+        return trajectory
+
+    def put(self, start, goal, trajectory):
+        """Store trajectory planned from start to goal"""
+        if len(trajectory.joint_trajectory.points) > 0:
+            self.cache.put(self.key(start, goal), trajectory)
+
+    def stats(self):
+        """Get hit/miss counters"""
+        stats = self.cache.stats()
+        stats["invalid"] = self.invalid
+        return stats
+
+
 class Controller(Enum):
     MOVEIT = "position_joint_trajectory_controller"
     SERVO = "cartesian_controller"
@@ -0,0 +1,164 @@
+"""Staged processing pipeline connected by bounded queues"""
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Sentinel that is passed downstream when a pipeline is closed gracefully
+STOP = object()
+
+
+class Stage(threading.Thread):
+    """Worker thread that handles items from an input queue and forwards the results to an output queue"""
+
+    def __init__(self, name: str, handler: Callable[[Any], Any], inq: "queue.Queue[Any]",
+                 outq: Optional["queue.Queue[Any]"], stop_event: threading.Event,
+                 on_error: Optional[Callable[[str, Exception], None]] = None, timeout: float = 0.5,
+                 batch_size: int = 0) -> None:
+        """Initialize stage. Handler results that are None are not forwarded.
+
+        With batch_size > 0 the handler gets a list of up to batch_size items that were already queued and
+        returns a list of results.
+        """
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.handler = handler
+        self.inq = inq
+        self.outq = outq
+        self.stop_event = stop_event
+        self.on_error = on_error
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.processed = 0
+        self.errors = 0
+        self.full_waits = 0
+
+    def run(self) -> None:
+        """Thread run function blocks on the input queue until an item or the stop signal arrives"""
+        while not self.stop_event.is_set():
+            try:
+                item = self.inq.get(timeout=self.timeout)
+            except queue.Empty:
+                continue
+            if self.batch_size > 0:
+                if not self.handle_batch(item):
+                    return
+                continue
+            if item is STOP:
+                self.forward(STOP)
+                return
+            try:
+                result = self.handler(item)
+            except Exception as e:  # pylint: disable=W0703
+                self.report(e)
+                continue
+            self.processed += 1
+            if result is not None and not self.forward(result):
+                return
+
+    def handle_batch(self, item: Any) -> bool:
+        """Handle item together with items already waiting in queue. Returns False if stage should exit"""
+        batch = []
+        stop = item is STOP
+        if not stop:
+            batch.append(item)
+        while not stop and len(batch) < self.batch_size:
+            try:
+                item = self.inq.get_nowait()
+            except queue.Empty:
+                break
+            if item is STOP:
+                stop = True
+            else:
+                batch.append(item)
+        if len(batch) > 0:
+            try:
+                results = self.handler(batch)
+            except Exception as e:  # pylint: disable=W0703
+                self.report(e)
+                results = []
+            else:
+                self.processed += len(batch)
+            for result in results:
+                if result is not None and not self.forward(result):
+                    return False
+        if stop:
+            self.forward(STOP)
+            return False
+        return True
+
+    def report(self, error: Exception) -> None:
+        """Count handler error and pass it to error callback"""
+        self.errors += 1
+        if self.on_error is not None:
+            self.on_error(self.name, error)
+
+    def forward(self, item: Any) -> bool:
+        """Put item to output queue, blocks while the next stage is full. Returns False if stopped meanwhile"""
+        if self.outq is None:
+            return True
+        while not self.stop_event.is_set():
+            try:
+                self.outq.put(item, timeout=self.timeout)
+                return True
+            except queue.Full:
+                self.full_waits += 1
+        return False
+
+
+class Pipeline:
+    """Chain of stages where each stage runs in its own worker thread"""
+
+    def __init__(self, source: "queue.Queue[Any]", queue_size: int = 16,
+                 on_error: Optional[Callable[[str, Exception], None]] = None, timeout: float = 0.5) -> None:
+        """Initialize pipeline that reads its input from source queue"""
+        self.source = source
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self.timeout = timeout
+        self.stop_event = threading.Event()
+        self.handlers: List[Tuple[str, Callable[[Any], Any], int]] = []
+        self.stages: List[Stage] = []
+
+    def add_stage(self, name: str, handler: Callable[[Any], Any], batch_size: int = 0) -> "Pipeline":
+        """Append stage to the end of the pipeline, see Stage for batch_size"""
+        self.handlers.append((name, handler, batch_size))
+        return self
+
+    def start(self) -> None:
+        """Create queues between stages and start worker threads"""
+        inq = self.source
+        for idx, (name, handler, batch_size) in enumerate(self.handlers):
+            outq: Optional["queue.Queue[Any]"] = None
+            if idx < len(self.handlers) - 1:
+                outq = queue.Queue(maxsize=self.queue_size)
+            stage = Stage(name, handler, inq, outq, self.stop_event, self.on_error, self.timeout, batch_size)
+            self.stages.append(stage)
+            if outq is not None:
+                inq = outq
+        for stage in self.stages:
+            stage.start()
+
+    def close(self) -> None:
+        """Let stages finish already queued items and then exit"""
+        try:
+            self.source.put(STOP, timeout=self.timeout)
+        except queue.Full:
+            self.stop()
+
+    def stop(self) -> None:
+        """Signal all stages to exit as soon as possible"""
+        self.stop_event.set()
+
+    def is_alive(self) -> bool:
+        """Check if any stage is still running"""
+        return any(stage.is_alive() for stage in self.stages)
+
+    def wait(self) -> None:
+        """Block until all stages have exited"""
+        for stage in self.stages:
+            while stage.is_alive():
+                stage.join(self.timeout)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Get processed/error/backpressure counters per stage"""
+        return {stage.name: {"processed": stage.processed, "errors": stage.errors, "full_waits": stage.full_waits}
+                for stage in self.stages}
@@ -0,0 +1,148 @@
+"""Offline replay of recorded audio through the speech recognizer"""
+import queue
+import threading
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+
+from nlihrc.pipeline import STOP
+
+
+def read_chunks(path, chunk, rate):
+    """Read WAV (16 bit mono) or raw int16 file in chunk sized frames, last frame is zero padded"""
+    chunk_bytes = 2 * chunk
+    if Path(path).suffix.lower() == '.wav':
+        with wave.open(str(path), 'rb') as wav:
+            if wav.getsampwidth() != 2 or wav.getnchannels() != 1 or wav.getframerate() != rate:
+                raise ValueError(f"{path} must be 16 bit mono audio at {rate} Hz")
+            while True:
+                data = wav.readframes(chunk)
+                if len(data) == 0:
+                    return
+                yield data.ljust(chunk_bytes, b'\0')
+    else:
+        with open(path, 'rb') as raw:
+            while True:
+                data = raw.read(chunk_bytes)
+                if len(data) == 0:
+                    return
+                yield data.ljust(chunk_bytes, b'\0')
+
+
+class ReplayReceiver(threading.Thread):
+    """Streams recorded audio files to queue in chunk sized frames, at real-time pace or as fast as possible.
+
+    Silence is appended to every file so an utterance at the end of a file gets finalized. STOP is put to the
+    queue once all files have been streamed.
+    """
+
+    def __init__(self, paths, chunk, rate, realtime=True, queue_size=0, trailing_silence=1.0):
+        """Initialize configuration"""
+        threading.Thread.__init__(self, daemon=True)
+        self.q = queue.Queue(maxsize=queue_size)
+        self.close_thread = False
+        self.paths = paths
+        self.chunk = chunk
+        self.rate = rate
+        self.realtime = realtime
+        self.silence_chunks = int(np.ceil(trailing_silence * rate / chunk))
+        self.chunks = 0
+
+    def frames(self):
+        """Get all frames of all files followed by trailing silence"""
+        silence = bytes(2 * self.chunk)
+        for path in self.paths:
+            yield from read_chunks(path, self.chunk, self.rate)
+            for _ in range(self.silence_chunks):
+                yield silence
+
+    def run(self):
+        """Thread run function puts frames to queue"""
+        period = self.chunk / self.rate
+        start = time.monotonic()
+        for data in self.frames():
+            if self.close_thread:
+                break
+            if self.realtime:
+                delay = start + self.chunks * period - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.q.put(data)
+            self.chunks += 1
+        self.q.put(STOP)
+
+    def stop(self):
+        """Signal thread to exit"""
+        self.close_thread = True
+
+
+def run_benchmark(rec, source, on_text=None):
+    """Feed frames from source to recognizer until STOP and measure timings.
+
+    End-of-speech-to-text latency is the silence the VAD waited after the last voiced chunk plus the time
+    from receiving the final chunk to having the text.
+    """
+    chunk_seconds = source.chunk / source.rate
+    vad_times = []
+    decode_times = []
+    final_times = []
+    latencies = []
+    utterance_decode = 0.0
+    t_start = time.perf_counter()
+    while True:
+        data = source.q.get()
+        if data is STOP:
+            break
+        t_received = time.perf_counter()
+        segment = rec.detect(data)
+        vad_times.append(time.perf_counter() - t_received)
+        if segment is None:
+            continue
+        t_decode = time.perf_counter()
+        words, number, deleted = rec.transcribe(*segment)
+        t_text = time.perf_counter()
+        utterance_decode += t_text - t_decode
+        if not rec.utterance_done:
+            continue
+        decode_times.append(utterance_decode)
+        final_times.append(t_text - t_decode)
+        latencies.append(rec.silent_chunks * chunk_seconds + t_text - t_received)
+        utterance_decode = 0.0
+        if on_text is not None:
+            on_text(words, number, deleted)
+    wall = time.perf_counter() - t_start
+    audio = source.chunks * chunk_seconds
+
+    def ms(values, func):
+        return 1000 * func(values) if len(values) > 0 else 0.0
+
+    return {
+        "audio_s": audio,
+        "wall_s": wall,
+        "rtf": wall / audio if audio > 0 else 0.0,
+        "chunks": source.chunks,
+        "vad_ms_mean": ms(vad_times, np.mean),
+        "vad_ms_max": ms(vad_times, np.max),
+        "utterances": len(decode_times),
+        "decode_ms_mean": ms(decode_times, np.mean),
+        "decode_ms_max": ms(decode_times, np.max),
+        "final_decode_ms_mean": ms(final_times, np.mean),
+        "latency_ms_mean": ms(latencies, np.mean),
+        "latency_ms_max": ms(latencies, np.max),
+    }
+
+
+def run_replay(config, paths, realtime=False, on_text=None):
+    """Replay files through a recognizer built from config, returns benchmark results"""
+    from nlihrc.speech import get_recognizer  # pylint: disable=C0415
+
+    rec = get_recognizer(config)
+    source = ReplayReceiver(paths, config['speech']['chunk'], config['speech']['rate'], realtime,
+                            config.get('pipeline', {}).get('queuesize', 16))
+    source.start()
+    try:
+        return run_benchmark(rec, source, on_text)
+    finally:
+        source.stop()
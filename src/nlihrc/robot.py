@@ -1,11 +1,13 @@
 """Robot Manipulation Module"""
 
 import copy
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 import rospy
 import moveit_commander
 import actionlib
 import time
-from controller_manager_msgs.srv import SwitchController
+from controller_manager_msgs.srv import ListControllers, SwitchController, SwitchControllerRequest
 import franka_gripper.msg
 import franka_msgs.msg
 from actionlib_msgs.msg import GoalStatusArray
@@ -13,30 +15,77 @@ from moveit_msgs.msg import RobotTrajectory
 import geometry_msgs.msg
 from std_msgs.msg import String
 
-from nlihrc.misc import GoalStatus, CommandMode, Command, Controller, MoveDirection, get_relative_orientation, CLIPORT_CMDS
+from nlihrc.misc import GoalStatus, CommandMode, Command, Controller, MoveDirection, get_relative_orientation, CLIPORT_CMDS, \
+    PlanCache
 from nlihrc.cliport_client import CliportClient
 
 
 class ControllerSwitcher:
-    def __init__(self, active: Controller, stopped: Controller) -> None:
-        """Initialize switch service"""
+    SWITCH_SERVICE = '/controller_manager/switch_controller'
+    LIST_SERVICE = '/controller_manager/list_controllers'
+
+    def __init__(self, active: Controller, stopped: Controller, timeout: float = 1.0) -> None:
+        """Initialize switch service. Service connections are kept open and reopened if a call fails"""
         self.active = active
         self.stopped = stopped
-        self.strictness = 2
-        self.start_asap = False
-        self.timeout = 0.0
+        self.strictness = SwitchControllerRequest.STRICT
+        self.start_asap = True
+        # Max seconds to wait for services and for the switch to complete
+        self.timeout = timeout
+        self.proxies = {}
+        self.switches = 0
+
+    def call(self, name, service_class, *args):
+        """Call service through persistent proxy, reconnects once if the connection was lost"""
+        for attempt in range(2):
+            proxy = self.proxies.get(name)
+            try:
+                if proxy is None:
+                    rospy.wait_for_service(name, self.timeout)
+                    proxy = rospy.ServiceProxy(name, service_class, persistent=True)
+                    self.proxies[name] = proxy
+                return proxy(*args)
+            except (rospy.ServiceException, rospy.ROSException) as e:
+                self.proxies.pop(name, None)
+                if proxy is not None:
+                    proxy.close()
+                if attempt == 1:
+                    raise
+                rospy.logwarn(f"Reconnecting to {name} after: {e}")
+        return None
+
+    def query_state(self):
+        """Get controller name to state ('running', 'stopped', ...) from controller manager"""
+        response = self.call(self.LIST_SERVICE, ListControllers)
+        return {controller.name: controller.state for controller in response.controller}
+
+    def is_switched(self, active: Controller, stop: Controller, states) -> bool:
+        """Check if active is running and stop is not"""
+        return states.get(active.value) == 'running' and states.get(stop.value) != 'running'
 
     def switch_controller(self, active: Controller, stop: Controller):
-        if self.active == active:
-            return
-        rospy.wait_for_service('/controller_manager/switch_controller')
         try:
-            switcher = rospy.ServiceProxy('/controller_manager/switch_controller', SwitchController)
-            switcher([active.value], [stop.value], self.strictness, self.start_asap, self.timeout)
+            states = self.query_state()
+            if self.is_switched(active, stop, states):
+                self.active = active
+                self.stopped = stop
+                return
+            response = self.call(self.SWITCH_SERVICE, SwitchController, [active.value], [stop.value],
+                                 self.strictness, self.start_asap, self.timeout)
+            if not response.ok:
+                rospy.logerr(f"Controller manager refused switching to {active.value}")
+                return
+            # Switch is applied in the control loop, wait until controller manager reports it
+            deadline = time.monotonic() + self.timeout
+            while not self.is_switched(active, stop, self.query_state()):
+                if time.monotonic() > deadline:
+                    rospy.logerr(f"Switching to {active.value} did not complete in {self.timeout} s")
+                    return
+                time.sleep(0.002)
             self.active = active
             self.stopped = stop
-            rospy.sleep(0.1)
-        except rospy.ServiceException as e:
+            self.switches += 1
+        except (rospy.ServiceException, rospy.ROSException) as e:
             rospy.logerr("Service call failed: %s"%e)
 
 
@@ -64,6 +113,11 @@ class Manipulator:
         self.error_recover_pub = rospy.Publisher("/franka_control/error_recovery/goal", franka_msgs.msg.ErrorRecoveryActionGoal, queue_size=1)
         self.robot_mode_sub = rospy.Subscriber("/franka_state_controller/franka_states",
             franka_msgs.msg.FrankaState, self.franka_state_callback,)
+        # Max seconds to wait for a gripper action
+        self.gripper_timeout = self.config['robot'].get('grippertimeout', 5.0)
+        # Joint space plans of repeated moves (home, handover)
+        self.plan_cache = PlanCache(self.config['robot'].get('plancache', 32),
+                                    self.config['robot'].get('planresolution', 0.01))
         # Transformation Matrices
         # Bring robot to home position during initialization
         self.moveit_home(wait=True)
@@ -84,21 +138,51 @@ class Manipulator:
 
     def moveit_home(self, wait=True):
         """Goto home position"""
-        # Clear existing pose targets
-        self.move_group.clear_pose_targets()
-        # Plan home joint values
-        self.move_group.set_joint_value_target(self.home_joints)
-        plan = self.move_group.plan()
+        plan = self.plan_joint_target(self.home_joints)
         self.moveit_execute_plan(plan, wait)
 
     def moveit_pose(self, target_joint_pose, wait=True):
         """Goto joint position"""
+        plan = self.plan_joint_target(target_joint_pose)
+        self.moveit_execute_plan(plan, wait)
+
+    def plan_joint_target(self, target_joint_pose, start=None):
+        """Plan to joint values from the current or given start joint values.
+
+        Reuses the cached plan if the same move was planned from the same start state.
+        """
+        names = self.move_group.get_active_joints()
+        if start is None:
+            start = self.move_group.get_current_joint_values()
+        cached = self.plan_cache.get(names, start, target_joint_pose)
+        if cached is not None:
+            rospy.loginfo(f"Using cached plan, {self.plan_cache.stats()}")
+            return [True, cached]
         # Clear existing pose targets
         self.move_group.clear_pose_targets()
+        self.move_group.set_start_state(self.start_state(names, start))
         # Plan goal joint values
         self.move_group.set_joint_value_target(target_joint_pose)
         plan = self.move_group.plan()
-        self.moveit_execute_plan(plan, wait)
+        self.move_group.set_start_state_to_current_state()
+        if plan[0]:
+            self.plan_cache.put(start, target_joint_pose, plan[1])
+        return plan
+
+    def start_state(self, names, positions):
+        """Current robot state with joints set to positions"""
+        state = self.robot.get_current_state()
+        joint_positions = list(state.joint_state.position)
+        for name, position in zip(names, positions):
+            joint_positions[state.joint_state.name.index(name)] = position
+        state.joint_state.position = joint_positions
+        return state
+
+    @staticmethod
+    def end_positions(names, trajectory):
+        """Joint values of names at the end of trajectory"""
+        last = dict(zip(trajectory.joint_trajectory.joint_names, trajectory.joint_trajectory.points[-1].positions))
+        return [last[name] for name in names]
 
     def moveit_execute_plan(self, plan, wait=True) -> None:
         """Execute a given plan through move group"""
@@ -108,9 +192,10 @@ class Manipulator:
             self.move_group.execute(plan[1], wait=True)
         else:
             rospy.logwarn("Could not plan trajectory from current pose to home pose")
-        
-    def moveit_execute_cartesian_path(self, waypoints):
-        """Execute cartesian path with some safety checks regarding pose waypoints"""
+
+    @staticmethod
+    def clamp_waypoints(waypoints):
+        """Safety checks regarding pose waypoints"""
         z_min, z_max = 0.01, 0.50
         for pose in waypoints:
             if pose.position.z < z_min:
@@ -119,29 +204,128 @@ class Manipulator:
             if pose.position.z > z_max:
                 rospy.logwarn(f"{pose.position.z = } is invalid. Using {z_max} instead")
                 pose.position.z = z_max
-        plan, _ = self.move_group.compute_cartesian_path(waypoints, 0.01, 0.0)  # jump_threshold
-        plan = self.move_group.retime_trajectory(self.robot.get_current_state(),
-                                                 plan,
-                                                 0.2)
-        self.moveit_execute_plan(plan)
-    
-    def open_gripper(self) -> None:
-        """Open gripper"""
+
+    def plan_cartesian_path(self, waypoints, start=None):
+        """Plan and retime cartesian path from the current or given start joint values.
+
+        Returns (trajectory, fraction), fraction is the part of the path that could be planned (1.0 is all of it).
+        """
+        self.clamp_waypoints(waypoints)
+        state = self.robot.get_current_state()
+        if start is not None:
+            state = self.start_state(self.move_group.get_active_joints(), start)
+        self.move_group.set_start_state(state)
+        plan, fraction = self.move_group.compute_cartesian_path(waypoints, 0.01, 0.0)  # jump_threshold
+        self.move_group.set_start_state_to_current_state()
+        return self.move_group.retime_trajectory(state, plan, 0.2), fraction
+
+    def moveit_execute_cartesian_path(self, waypoints):
+        """Execute cartesian path with some safety checks regarding pose waypoints"""
+        self.moveit_execute_plan(self.plan_cartesian_path(waypoints)[0])
+
+    def plan_sequence(self, steps):
+        """Plan all moves of a sequence before moving, each move starts where the previous one ends.
+
+        Steps are ('cartesian', waypoints), ('joints', joint values) or gripper tuples (see execute_sequence).
+        Returns steps with moves replaced by ('execute', trajectory) or None if any move could not be planned in full,
+        a partial cartesian path would leave the gripper acting at the wrong pose.
+        """
+        names = self.move_group.get_active_joints()
+        position = self.move_group.get_current_joint_values()
+        planned = []
+        for kind, target in steps:
+            if kind in ('gripper', 'gripper_early'):
+                planned.append((kind, target))
+                continue
+            if kind == 'cartesian':
+                trajectory, fraction = self.plan_cartesian_path(target, position)
+                if fraction < 1.0:
+                    rospy.logwarn(f"Could plan only {100 * fraction:.0f} % of a cartesian move of the sequence, "
+                                  "not moving")
+                    return None
+            else:
+                success, trajectory, *_ = self.plan_joint_target(target, position)
+                if not success:
+                    rospy.logwarn(f"Could not plan joint move of the sequence, not moving")
+                    return None
+            if len(trajectory.joint_trajectory.points) == 0:
+                # Already at target
+                continue
+            planned.append(('execute', trajectory))
+            position = self.end_positions(names, trajectory)
+        return planned
+
+    def execute_sequence(self, planned, cancel=None):
+        """Execute planned sequence, stops before the next step once cancel event is set.
+
+        A ('gripper', open) action starts once the move before it has finished, a ('gripper_early', open) action
+        starts together with the move before it. Every move first waits for the gripper actions before it.
+        """
+        pending = []
+        early = None
+        for idx, (kind, target) in enumerate(planned):
+            if cancel is not None and cancel.is_set():
+                return
+            if kind == 'execute':
+                # Join point, e.g. gripper must be open before descending and closed before lifting
+                self.join_gripper(pending)
+                pending = []
+                if idx + 1 < len(planned) and planned[idx + 1][0] == 'gripper_early':
+                    early = idx + 1
+                    pending.append(self.gripper_async(planned[early][1]))
+                self.move_group.execute(target, wait=True)
+            elif kind == 'gripper' or idx != early:
+                pending.append(self.gripper_async(target))
+        self.join_gripper(pending)
+
+    def cancel_motion(self):
+        """Stop MoveIt execution and cancel gripper goals"""
+        self.move_group.stop()
+        self.move_action_client.cancel_all_goals()
+        self.grasp_action_client.cancel_all_goals()
+
+    def send_gripper_goal(self, client, goal):
+        """Send gripper goal, returned future is done with the action result once the action has finished"""
+        future = Future()
+        future.set_running_or_notify_cancel()
+        client.send_goal(goal, done_cb=lambda state, result: future.set_result(result))
+        return future
+
+    def join_gripper(self, futures):
+        """Wait until gripper actions have finished"""
+        for future in futures:
+            try:
+                future.result(self.gripper_timeout)
+            except FutureTimeoutError:
+                rospy.logwarn(f"Gripper action did not finish in {self.gripper_timeout} s")
+
+    def gripper_async(self, open):
+        """Start opening or closing gripper"""
+        return self.open_gripper_async() if open else self.close_gripper_async()
+
+    def open_gripper_async(self):
+        """Start opening gripper, returns future"""
         goal = franka_gripper.msg.MoveGoal()
         goal.width = 0.08
         goal.speed = 0.1
-        self.move_action_client.send_goal(goal)
-        self.move_action_client.wait_for_result()
+        return self.send_gripper_goal(self.move_action_client, goal)
 
-    def close_gripper(self):
-        """Grasp object by closing gripper"""
+    def close_gripper_async(self):
+        """Start grasping object by closing gripper, returns future"""
         goal = franka_gripper.msg.GraspGoal()
         goal.width = 0.00
         goal.speed = 0.1
         goal.force = 5  # limits 0.01 - 50 N
         goal.epsilon = franka_gripper.msg.GraspEpsilon(inner=0.08, outer=0.08)
-        self.grasp_action_client.send_goal(goal)
-        self.grasp_action_client.wait_for_result()
+        return self.send_gripper_goal(self.grasp_action_client, goal)
+
+    def open_gripper(self) -> None:
+        """Open gripper"""
+        self.join_gripper([self.open_gripper_async()])
+
+    def close_gripper(self):
+        """Grasp object by closing gripper"""
+        self.join_gripper([self.close_gripper_async()])
 
     def servo_move(self, data):
         """Publish command to servo controller"""
@@ -162,12 +346,15 @@ class CommandGenerator:
         # Commands that rely on numeric value use this parameter
         self.cmd_param = None
         # Controller switcher
-        self.controller_switcher = ControllerSwitcher(active=Controller.MOVEIT, stopped=Controller.SERVO)
+        self.controller_switcher = ControllerSwitcher(active=Controller.MOVEIT, stopped=Controller.SERVO,
+                                                      timeout=self.config['robot'].get('switchtimeout', 1.0))
         # Cliport client that sends language input and expects pick-place poses from Cliport server
-        self.cliport = CliportClient()
+        self.cliport = CliportClient(self.config.get('cliport', {}).get('requestids', False))
         # Saved positions
         self.saved_positions = {}
         self.repeat_times = 1
+        # Set when a preempting command arrives, sequences return before their next step
+        self.cancel = threading.Event()
 
         self.cmds = {
             Command.START_ROBOT: lambda: self.setup_robot(True),
@@ -285,6 +472,12 @@ class CommandGenerator:
 
         self.manipulator.servo_move(move_param)
     
+    def preempt(self):
+        """Cancel running command, called from the scheduler when a preempting command arrives"""
+        self.cancel.set()
+        self.cliport.wake()
+        self.manipulator.cancel_motion()
+
     def stop_execution(self):
         """Stop running execution"""
         if self.controller_switcher.active == Controller.SERVO:
@@ -323,20 +516,21 @@ class CommandGenerator:
 
     def cliport_cmd(self, language_input):
         i = self.repeat_times
-        while i > 0:
+        while i > 0 and not self.cancel.is_set():
             """Run cliport command"""
             if self.mode != CommandMode.MODEL:
                 rospy.logwarn("CLIPORT commands are only supported in MODEL mode")
                 return
-            self.cliport.publish(language_input)
-            # Wait for server
-            rospy.sleep(2.0)
-            if self.cliport.data is None:
+            data = self.cliport.request(language_input, self.config.get('cliport', {}).get('timeout', 10.0),
+                                        self.cancel)
+            if self.cancel.is_set():
+                # Stopped while waiting for the poses
+                break
+            if data is None:
                 rospy.logwarn("CLIPORT client did not receive any output from CLIPORT server")
                 return
-            self.cmd_param = self.cliport.data.copy()
-            self.cliport.data = None
-            rospy.loginfo(language_input)
+            self.cmd_param = data
+            rospy.loginfo(f"{language_input} ({self.cliport.stats()})")
             if language_input == CLIPORT_CMDS[5]:
                 self.pick_only()
             elif "give" in language_input.lower():
@@ -349,9 +543,11 @@ class CommandGenerator:
 
     def pick_only(self):
         """Execute only a pick sequence"""
-        if self.cmd_param is None:
+        if self.cmd_param is None or self.cancel.is_set():
             return
         self.home()
+        if self.cancel.is_set():
+            return
         # Get ee pose
         ee_pose = self.manipulator.move_group.get_current_pose()
         ee_wxyz = [ee_pose.pose.orientation.w,
@@ -365,9 +561,11 @@ class CommandGenerator:
 
     def pick_place(self):
         """Execute pick/place sequence given the poses"""
-        if self.cmd_param is None:
+        if self.cmd_param is None or self.cancel.is_set():
             return
         self.home()
+        if self.cancel.is_set():
+            return
         # Get ee pose
         ee_pose = self.manipulator.move_group.get_current_pose()
         ee_wxyz = [ee_pose.pose.orientation.w,
@@ -378,6 +576,8 @@ class CommandGenerator:
         pick_wxyz = get_relative_orientation(ee_wxyz, self.cmd_param['pick_rotation'])
         pick_xyz = self.cmd_param['pick_xyz']
         self._pick(pick_xyz, pick_wxyz)
+        if self.cancel.is_set():
+            return
         # Execute place
         place_wxyz = get_relative_orientation(ee_wxyz, self.cmd_param['place_rotation'])
         place_xyz = self.cmd_param['place_xyz']
@@ -385,6 +585,8 @@ class CommandGenerator:
 
     def pick_give(self):
         self.pick_only()
+        if self.cancel.is_set():
+            return
         self.controller_switcher.switch_controller(Controller.MOVEIT, Controller.SERVO)
         self.manipulator.moveit_pose(self.config['robot']['handover_joints3'], True)
 
@@ -403,13 +605,16 @@ class CommandGenerator:
         pose.orientation.y = wxyz[2]
         pose.orientation.z = wxyz[3]
 
-        # Move above object and open gripper
-        self.home()
+        # Move above object, open gripper and return home. Every move is planned before the arm starts moving
+        self.controller_switcher.switch_controller(Controller.MOVEIT, Controller.SERVO)
+        home_joints = self.manipulator.home_joints
+        planned = self.manipulator.plan_sequence([('joints', home_joints), ('cartesian', [pose]), ('gripper', True),
+                                                  ('joints', home_joints)])
+        if planned is None:
+            return
         rospy.loginfo("Moving towards place object and opening gripper")
-        self.manipulator.moveit_execute_cartesian_path([pose])
-        self.oc_gripper(True)
-        self.home()
-    
+        self.manipulator.execute_sequence(planned, self.cancel)
+
     def _pick(self, xyz, wxyz):
         """Execute pick sequence"""
         # This is used to execute up-down movement when grasping the target
@@ -426,20 +631,18 @@ class CommandGenerator:
         pose.orientation.y = wxyz[2]
         pose.orientation.z = wxyz[3]
 
-        # Move above object and open gripper
-        rospy.loginfo("Moving towards pick object and opening gripper")
         pose_up = copy.deepcopy(pose)
         pose_up.position.z += z_offset_up
-        self.manipulator.moveit_execute_cartesian_path([pose_up])
-        self.oc_gripper(True)
-        # Move down and grasp object
-        rospy.loginfo("Moving down and grasping pick object")
         pose_down = copy.deepcopy(pose)
         pose_down.position.z -= z_offset_down
-        self.manipulator.moveit_execute_cartesian_path([pose_down])
-        self.oc_gripper(False)
-        # Move up again
-        rospy.loginfo("Moving up again after picking object")
         pose_up_2 = copy.deepcopy(pose)
         pose_up_2.position.z += z_offset_up_2
-        self.manipulator.moveit_execute_cartesian_path([pose_up_2])
+        # Move above object while opening gripper, move down and grasp object, move up again.
+        # Every move is planned before the arm starts moving.
+        planned = self.manipulator.plan_sequence([('cartesian', [pose_up]), ('gripper_early', True),
+                                                  ('cartesian', [pose_down]), ('gripper', False),
+                                                  ('cartesian', [pose_up_2])])
+        if planned is None:
+            return
+        rospy.loginfo("Picking object")
+        self.manipulator.execute_sequence(planned, self.cancel)
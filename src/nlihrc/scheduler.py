@@ -0,0 +1,194 @@
+"""Preemptible robot command scheduler"""
+import collections
+import itertools
+import queue
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from nlihrc.misc import Command
+
+# Commands that cancel the running command and every command queued before them
+PREEMPTING = {Command.STOP_EXECUTION, Command.STOP_ROBOT, Command.RECOVER, Command.HOME}
+
+# Commands that are never dropped or coalesced, even if the queue is full
+PROTECTED = {Command.START_ROBOT, Command.STOP_ROBOT, Command.SET_MODE_STEP, Command.SET_MODE_CONTINUOUS,
+             Command.SET_MODE_MODEL, Command.OPEN_TOOL, Command.CLOSE_TOOL}
+
+# Mode commands, they decide if the jogs queued after them can be coalesced
+MODES = {Command.SET_MODE_STEP, Command.SET_MODE_CONTINUOUS, Command.SET_MODE_MODEL}
+
+# Jog commands, consecutive ones can be coalesced into the newest one
+JOGS = {Command.MOVE_UP, Command.MOVE_DOWN, Command.MOVE_LEFT, Command.MOVE_RIGHT, Command.MOVE_FRONT,
+        Command.MOVE_BACK}
+
+
+class CommandQueue:
+    """Thread-safe bounded command queue with sequence numbers.
+
+    Urgent commands are taken before the others. A jog command replaces a jog command that is the newest queued
+    one when coalesce(mode) is true, mode is the newest queued mode command (the mode the jogs will run in) or None
+    if no mode command is queued. When the queue is full the oldest command that is not protected is dropped,
+    protected and urgent commands are queued over the bound instead (counted as overflow).
+    """
+
+    def __init__(self, maxsize: int = 32, coalesce: Optional[Callable[[Optional[Command]], bool]] = None) -> None:
+        """Initialize queue, maxsize <= 0 is unbounded"""
+        self.maxsize = maxsize
+        self.coalesce = coalesce
+        self.cond = threading.Condition()
+        self.urgent: Deque[Tuple[int, Command, Any]] = collections.deque()
+        self.normal: Deque[Tuple[int, Command, Any]] = collections.deque()
+        self.seqs = itertools.count()
+        self.dropped = 0
+        self.coalesced = 0
+        self.overflows = 0
+
+    def qsize(self) -> int:
+        """Get number of queued commands"""
+        with self.cond:
+            return len(self.urgent) + len(self.normal)
+
+    def put(self, cmd: Command, number=None, urgent: bool = False) -> Tuple[int, List[Tuple[str, int, Command]]]:
+        """Queue command. Returns its sequence number and ('coalesced' or 'dropped', seq, cmd) of removed commands"""
+        removed = []
+        with self.cond:
+            seq = next(self.seqs)
+            if urgent:
+                self.urgent.append((seq, cmd, number))
+            else:
+                if cmd in JOGS and len(self.normal) > 0 and self.normal[-1][1] in JOGS and \
+                        self.coalesce is not None and self.coalesce(self.queued_mode()):
+                    old_seq, old_cmd, _ = self.normal.pop()
+                    self.coalesced += 1
+                    removed.append(("coalesced", old_seq, old_cmd))
+                self.normal.append((seq, cmd, number))
+            if 0 < self.maxsize < len(self.urgent) + len(self.normal):
+                victim = next((item for item in self.normal if item[1] not in PROTECTED), None)
+                if victim is None:
+                    self.overflows += 1
+                else:
+                    self.normal.remove(victim)
+                    self.dropped += 1
+                    removed.append(("dropped", victim[0], victim[1]))
+            self.cond.notify()
+        return seq, removed
+
+    def queued_mode(self) -> Optional[Command]:
+        """Get newest queued mode command, caller holds cond"""
+        return next((item[1] for item in reversed(self.normal) if item[1] in MODES), None)
+
+    def get(self, timeout: Optional[float] = None) -> Tuple[int, Command, Any]:
+        """Get (seq, cmd, number) of the next command, raises queue.Empty after timeout"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.urgent) + len(self.normal) > 0, timeout):
+                raise queue.Empty
+            if len(self.urgent) > 0:
+                return self.urgent.popleft()
+            return self.normal.popleft()
+
+    def stats(self) -> Dict[str, int]:
+        """Get queue counters"""
+        with self.cond:
+            return {"queued": len(self.urgent) + len(self.normal), "dropped": self.dropped,
+                    "coalesced": self.coalesced, "overflows": self.overflows}
+
+
+class CommandScheduler(threading.Thread):
+    """Worker thread that owns the robot and runs commands one at a time from a command queue.
+
+    A preempting command is queued ahead of other commands, sets cancel and calls preempt right away to cancel the
+    running command (e.g. stop MoveIt and gripper goals) and makes the worker skip commands submitted before it.
+    Long running commands should return once cancel is set, it is cleared when the next command starts.
+    Status changes are passed to publish_status as dicts.
+    """
+
+    def __init__(self, runner: Callable[[Command, Any], None], preempt: Optional[Callable[[], None]] = None,
+                 publish_status: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 on_error: Optional[Callable[[str, Exception], None]] = None,
+                 cancel: Optional[threading.Event] = None, preempting=None, queue_size: int = 32,
+                 coalesce: Optional[Callable[[Optional[Command]], bool]] = None) -> None:
+        """Initialize scheduler, runner(cmd, number) runs a command to completion. See CommandQueue for
+        queue_size and coalesce"""
+        threading.Thread.__init__(self, daemon=True)
+        self.q = CommandQueue(queue_size, coalesce)
+        self.close_thread = False
+        self.runner = runner
+        self.preempt = preempt
+        self.publish_status = publish_status
+        self.on_error = on_error
+        self.cancel = threading.Event() if cancel is None else cancel
+        self.preempting = PREEMPTING if preempting is None else preempting
+        self.lock = threading.Lock()
+        # Sequence number of the latest preempting command, older commands are skipped
+        self.preempt_seq = -1
+        self.current: Optional[Tuple[int, Command]] = None
+        self.preempted = 0
+        self.skipped = 0
+
+    def submit(self, cmd: Command, number=None) -> int:
+        """Queue command, returns its sequence number"""
+        running = None
+        if cmd in self.preempting:
+            with self.lock:
+                seq, removed = self.q.put(cmd, number, urgent=True)
+                self.preempt_seq = seq
+                running = self.current
+                self.cancel.set()
+                if self.preempt is not None:
+                    self.preempt()
+        else:
+            seq, removed = self.q.put(cmd, number)
+        if running is not None:
+            self.preempted += 1
+            self.status("preempted", running[1], running[0])
+        for state, old_seq, old_cmd in removed:
+            self.status(state, old_cmd, old_seq)
+        self.status("queued", cmd, seq)
+        return seq
+
+    def status(self, state: str, cmd: Command, seq: int) -> None:
+        """Publish status change"""
+        if self.publish_status is not None:
+            self.publish_status({"state": state, "command": cmd.name, "seq": seq, "queued": self.q.qsize(),
+                                 "time": time.time()})
+
+    def run(self) -> None:
+        """Thread run function"""
+        while not self.close_thread:
+            try:
+                seq, cmd, number = self.q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            with self.lock:
+                if seq < self.preempt_seq:
+                    self.skipped += 1
+                    skip = True
+                else:
+                    self.current = (seq, cmd)
+                    self.cancel.clear()
+                    skip = False
+            if skip:
+                self.status("skipped", cmd, seq)
+                continue
+            self.status("running", cmd, seq)
+            state = "done"
+            try:
+                self.runner(cmd, number)
+            except Exception as e:  # pylint: disable=W0703
+                state = "failed"
+                if self.on_error is not None:
+                    self.on_error(cmd.name, e)
+            with self.lock:
+                self.current = None
+            self.status(state, cmd, seq)
+
+    def stop(self) -> None:
+        """Signal thread to exit"""
+        self.close_thread = True
+
+    def stats(self) -> Dict[str, int]:
+        """Get preemption and queue counters"""
+        stats = self.q.stats()
+        stats.update({"preempted": self.preempted, "skipped": self.skipped})
+        return stats
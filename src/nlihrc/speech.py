@@ -7,16 +7,24 @@ import json
 import time
 from word2number import w2n
 from typing import Any, Tuple
-from nlihrc.misc import CLIPORT_CMDS
+from nlihrc.misc import ASR_GRAMMAR, ASR_NUMBERS, ASR_UNKNOWN_WORD, CLIPORT_CMDS, Command
+from nlihrc.audiobuffer import RingBuffer, UtteranceBuffer
 
 
 class OnnxWrapper():
     """OnnxWrapper for Voice Activity Detector"""
 
-    def __init__(self, path):
-        self.session = onnxruntime.InferenceSession(path)
-        self.session.intra_op_num_threads = 1
-        self.session.inter_op_num_threads = 1
+    def __init__(self, path, intra_op_threads=1, inter_op_threads=1):
+        # Thread counts only take effect through SessionOptions given when the session is created
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+        # Per chunk timing
+        self.calls = 0
+        self.elapsed = 0.0
 
         self.reset_states()
 
@@ -25,18 +33,36 @@ class OnnxWrapper():
         self._c = np.zeros((2, 1, 64)).astype('float32')
 
     def __call__(self, x, sr: int):
+        out, self._h, self._c = self.run_batch(x, self._h, self._c, sr)
+        return out[0]
+
+    def speech_prob(self, audio_int16, sr: int):
+        """Get speech probability of a raw int16 chunk"""
+        return self(int2float(audio_int16), sr)
+
+    def mean_time(self):
+        """Mean VAD time per chunk in seconds"""
+        return self.elapsed / self.calls if self.calls > 0 else 0.0
+
+    def run_batch(self, x, h, c, sr: int):
+        """Run model once for a batch of audio chunks.
+
+        x has shape (batch, samples) and states h/c have shape (2, batch, 64). Returns speech probabilities of
+        shape (batch,) and the new states. Model time is counted per chunk of the batch.
+        """
+        t1 = time.perf_counter()
         if x.ndim == 1:
             x = x[np.newaxis, ...]
         if x.ndim > 2:
-            raise ValueError(f"Too many dimensions for input audio chunk {x.dim}")
+            raise ValueError(f"Too many dimensions for input audio chunk {x.ndim}")
 
         if sr != 16000 and (sr % 16000 == 0):
             step = sr // 16000
-            x = x[::step]
+            x = x[:, ::step]
             sr = 16000
 
-        if x.shape[0] > 1:
-            raise ValueError("Onnx model does not support batching")
+        if x.shape[0] != h.shape[1] or x.shape[0] != c.shape[1]:
+            raise ValueError(f"Batch size {x.shape[0]} does not match states {h.shape[1]}, {c.shape[1]}")
 
         if sr not in [16000]:
             raise ValueError(f"Supported sample rates: {[16000]}")
@@ -44,13 +70,110 @@ class OnnxWrapper():
         if sr / x.shape[1] > 31.25:
             raise ValueError("Input audio chunk is too short")
 
-        ort_inputs = {'input': x, 'h0': self._h, 'c0': self._c}
-        ort_outs = self.session.run(None, ort_inputs)
-        out, self._h, self._c = ort_outs
+        ort_inputs = {'input': x, 'h0': h, 'c0': c}
+        out, h, c = self.session.run(None, ort_inputs)
+        self.calls += x.shape[0]
+        self.elapsed += time.perf_counter() - t1
 
         # out = torch.tensor(out).squeeze(2)[:, 1]  # make output type match JIT analog
 
-        return out.reshape((1, -1))[:, 1][0]
+        return out.reshape((x.shape[0], -1))[:, 1], h, c
+
+
+class IOBindingVad(OnnxWrapper):
+    """Single stream VAD that runs through IOBinding on preallocated input, state and output buffers.
+
+    Audio is normalized in place into a reused float32 buffer and h/c states are double buffered, so a chunk
+    is processed without allocating new arrays.
+    """
+
+    def __init__(self, path, intra_op_threads=1, inter_op_threads=1):
+        self.samples = 0
+        super().__init__(path, intra_op_threads, inter_op_threads)
+
+    def allocate(self, samples):
+        """Allocate buffers and bindings for chunks of given sample count"""
+        self.samples = samples
+        self.x = np.zeros((1, samples), dtype=np.float32)
+        self.scratch = np.zeros((1, samples), dtype=np.float32)
+        # Learn output shape from the model once
+        out = self.session.run(['output'], {'input': self.x, 'h0': self.h[0], 'c0': self.c[0]})[0]
+        self.out = np.zeros(out.shape, dtype=np.float32)
+        self.out_flat = self.out.reshape((1, -1))
+        # Binding i reads states from buffer i and writes them to the other buffer
+        self.bindings = []
+        for idx in range(2):
+            binding = self.session.io_binding()
+            self.bind(binding.bind_input, 'input', self.x)
+            self.bind(binding.bind_input, 'h0', self.h[idx])
+            self.bind(binding.bind_input, 'c0', self.c[idx])
+            self.bind(binding.bind_output, 'output', self.out)
+            self.bind(binding.bind_output, 'hn', self.h[1 - idx])
+            self.bind(binding.bind_output, 'cn', self.c[1 - idx])
+            self.bindings.append(binding)
+
+    @staticmethod
+    def bind(bind_func, name, array):
+        """Bind numpy array memory to input or output"""
+        bind_func(name, 'cpu', 0, np.float32, list(array.shape), array.ctypes.data)
+
+    def reset_states(self):
+        if not hasattr(self, 'h'):
+            self.h = [np.zeros((2, 1, 64), dtype=np.float32) for _ in range(2)]
+            self.c = [np.zeros((2, 1, 64), dtype=np.float32) for _ in range(2)]
+        self.h[0].fill(0)
+        self.c[0].fill(0)
+        self.state_idx = 0
+
+    def speech_prob(self, audio_int16, sr: int):
+        """Get speech probability of a raw int16 chunk"""
+        t1 = time.perf_counter()
+        if sr != 16000 and (sr % 16000 == 0):
+            audio_int16 = audio_int16[::sr // 16000]
+            sr = 16000
+        if sr not in [16000]:
+            raise ValueError(f"Supported sample rates: {[16000]}")
+        if sr / len(audio_int16) > 31.25:
+            raise ValueError("Input audio chunk is too short")
+        if len(audio_int16) != self.samples:
+            self.allocate(len(audio_int16))
+        # Same normalization as int2float without temporaries
+        np.copyto(self.x[0], audio_int16, casting='unsafe')
+        abs_max = np.abs(self.x, out=self.scratch).max()
+        if abs_max > 0:
+            self.x *= 1 / abs_max
+        self.session.run_with_iobinding(self.bindings[self.state_idx])
+        self.state_idx = 1 - self.state_idx
+        self.calls += 1
+        self.elapsed += time.perf_counter() - t1
+        return self.out_flat[0, 1]
+
+    def __call__(self, x, sr: int):
+        """Float chunks run without the bindings, new states are written back into the current state buffers"""
+        out, h, c = self.run_batch(x, self.h[self.state_idx], self.c[self.state_idx], sr)
+        np.copyto(self.h[self.state_idx], h)
+        np.copyto(self.c[self.state_idx], c)
+        return out[0]
+
+
+class VadStream:
+    """VAD state of one audio stream, model session is shared with other streams"""
+
+    def __init__(self, vad: OnnxWrapper) -> None:
+        self.vad = vad
+        self.reset_states()
+
+    def reset_states(self):
+        self.h = np.zeros((2, 1, 64)).astype('float32')
+        self.c = np.zeros((2, 1, 64)).astype('float32')
+
+    def __call__(self, x, sr: int):
+        out, self.h, self.c = self.vad.run_batch(x, self.h, self.c, sr)
+        return out[0]
+
+    def speech_prob(self, audio_int16, sr: int):
+        """Get speech probability of a raw int16 chunk"""
+        return self(int2float(audio_int16), sr)
 
 
 # Provided by Alexander Veysov
@@ -63,104 +186,295 @@ def int2float(sound):
     return sound
 
 
+def get_vad(config, batched=False):
+    """Create voice activity detector from config, batched VAD is shared by several streams"""
+    vad_config = config.get('vad', {})
+    path = str(Path(config['speech']['modelpath'], 'silero_vad.onnx'))
+    threads = (vad_config.get('intraopthreads', 1), vad_config.get('interopthreads', 1))
+    if vad_config.get('iobinding', False) and not batched:
+        return IOBindingVad(path, *threads)
+    return OnnxWrapper(path, *threads)
+
+
+def get_recognizer(config):
+    """Create single stream speech recognizer from config"""
+    return SpeechRecognizer(config['speech']['modelpath'], config['speech']['rate'], config['speech']['chunk'],
+                            config['speech'].get('streaming', False), get_vad(config),
+                            early_endpoint=config['speech'].get('earlyendpoint', False),
+                            endpoint_guard=config['speech'].get('endpointguard', 0.3))
+
+
 class SpeechRecognizer:
     """Handles vosk and vad speech to text"""
 
-    def __init__(self, model_path, sample_rate, chunk_size):
-        """Class Constructor"""
-        self.vad = OnnxWrapper(str(Path(model_path, 'silero_vad.onnx')))
-        self.audio_chunks = []
-        self.speech_start_idx = 0
-        self.speech_end_idx = 0
+    def __init__(self, model_path, sample_rate, chunk_size, streaming=False, vad=None, model=None,
+                 early_endpoint=False, endpoint_guard=0.3):
+        """Class Constructor. In streaming mode voiced chunks are decoded as they arrive.
+
+        vad and vosk model are loaded from model_path unless given, so sessions can share them.
+        With early_endpoint (streaming mode only) an utterance is finalized as soon as the partial result is a
+        complete command instead of waiting for the VAD hangover. Commands that may continue, e.g. with a number,
+        must stay unchanged for endpoint_guard seconds first.
+        """
+        if vad is None:
+            vad = OnnxWrapper(str(Path(model_path, 'silero_vad.onnx')))
+        self.vad = vad
+        self.streaming = streaming
+        # Partial text of the utterance being decoded (streaming mode only)
+        self.partial = ""
+        self.segments = []
+        # Set by transcribe when its call finished an utterance
+        self.utterance_done = False
+        self.silent_chunks = 0
         self.start_speech = False
         self.rate = sample_rate
         offset_duration = 0.5  # in seconds
         self.chunk_offset = 2 * int(np.ceil((self.rate * offset_duration) / chunk_size))
+        # Pre-roll keeps chunk_offset chunks of int16 audio before speech starts, utterance grows while speaking
+        self.preroll = RingBuffer(2 * self.chunk_offset * chunk_size)
+        self.utterance = UtteranceBuffer(4 * self.preroll.size)
 
-        self.numbers = ["one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten", "zero",
-                        "eleven", "twelve", "thirteen", "fourteen", "fifteen", "sixteen", "seventeen", "eighteen",
-                        "nineteen", "twenty", "thirty", "forty", "fifty", "sixty", "seventy", "eighty", "ninety",
-                        "hundred", "thousand", ]
-
-        self.unknown_word = "[unk]"
-
-        model = vosk.Model(model_path)
-        self.rec = vosk.KaldiRecognizer(model, self.rate, json.dumps([
-            # System commands
-            "start", "stop", "robot", "execution", "move", "go", "set mode", "continuous", "model", "step", "size",
-            "tool", "open", "close", "rotate", "save", "home", "position", "load", "place", "the", "recover", "repeat",
-            # Directions
-            "up", "down", "left", "right", "forward", "backward", "front", "back",
-            # numbers
-            *self.numbers,
-            "minus", "negative", "once", "twice", "thrice", "times",
-            # cliport
-            *CLIPORT_CMDS,
-            # other
-            "give", "long", "screw", "screws" "push", "rod", "rods", "cap", "piston", "rocker", "arm", "arms", "bolt",
-            "bolts",
-            # unknown
-            self.unknown_word]))
+        self.numbers = ASR_NUMBERS
+
+        self.unknown_word = ASR_UNKNOWN_WORD
+
+        # Early endpointing. detect runs in the VAD stage and transcribe in the ASR stage, so they only share
+        # utterance counters: endpoint_at is the index of the utterance transcribe has already finalized.
+        self.early_endpoint = early_endpoint and streaming
+        self.endpoint_guard = int(np.ceil((self.rate * endpoint_guard) / chunk_size))
+        self.partial_stable = 0
+        self.finals_sent = 0
+        self.finals_received = 0
+        self.endpoint_at = -1
+        self.draining = False
+        self.complete_phrases = set(CLIPORT_CMDS) | {member.name.lower().replace('_', ' ') for member in Command}
+        # Commands that take a numeric suffix
+        self.number_commands = ["step size", "rotate tool", "save position", "load position", "repeat"]
+        self.complete_phrases -= set(self.number_commands)
+        self.number_words = set(self.numbers) | {"minus", "negative", "once", "twice", "thrice", "times"}
+        # Complete phrases that another phrase continues need the guard too
+        self.guarded_phrases = {phrase for phrase in self.complete_phrases
+                                if any(other.startswith(phrase + ' ') for other in self.complete_phrases)}
+
+        if model is None:
+            model = vosk.Model(model_path)
+        self.rec = vosk.KaldiRecognizer(model, self.rate, json.dumps(ASR_GRAMMAR))
 
     def speech_to_text(self, data):
         """Convert speech to text using speech model recognizer"""
-        words = []
-        deleted = []
-        words_return = []
-        number = None
-        # Detect Speech
-        self.audio_chunks.append(data)
-        audio_int16 = np.frombuffer(data, np.int16)
-        audio_float32 = int2float(audio_int16)
-        output = self.vad(audio_float32, self.rate)
+        segment = self.detect(data)
+        if segment is None:
+            return [], None, []
+        return self.transcribe(*segment)
+
+    def detect(self, data, output=None):
+        """Run voice activity detection on a chunk.
+
+        Returns (audio, final) tuple of audio that should be decoded or None. Without streaming the whole buffered
+        utterance is returned once speech has ended, in streaming mode every voiced chunk is returned right away.
+        Speech probability can be given as output if VAD has already been run for the chunk.
+        """
+        if self.start_speech and self.endpoint_at == self.finals_sent:
+            # Utterance was finalized early, end it without waiting for the hangover
+            self.start_speech = False
+            self.draining = True
+            self.silent_chunks = 0
+            self.finals_sent += 1
+            self.utterance.clear()
+            return b'', True
+        if output is None:
+            output = self.vad.speech_prob(np.frombuffer(data, np.int16), self.rate)
+        if self.draining:
+            # Tail of the early finalized utterance must not start a new one
+            if output > 0.5:
+                return None
+            self.draining = False
+            self.vad.reset_states()
         if output > 0.5:
+            self.silent_chunks = 0
             if not self.start_speech:
-                self.speech_start_idx = len(self.audio_chunks) - 1
-            self.start_speech = True
-            self.speech_end_idx = len(self.audio_chunks) + self.chunk_offset
-        else:
-            if self.start_speech and len(self.audio_chunks) > self.speech_end_idx:
-                start_idx = max(0, self.speech_start_idx - self.chunk_offset)
+                self.start_speech = True
+                # Pre-roll followed by first voiced chunk
+                self.utterance.clear()
+                self.preroll.read_into(self.utterance)
+                self.preroll.clear()
+                self.utterance.write(data)
+                if self.streaming:
+                    return self.utterance.tobytes(), False
+                return None
+        elif self.start_speech:
+            self.silent_chunks += 1
+            if self.silent_chunks > self.chunk_offset:
                 self.start_speech = False
-                speech = b''.join(self.audio_chunks[start_idx:])
-                self.audio_chunks = []
-                # Convert speech to text
-                self.rec.AcceptWaveform(speech)
-                words = json.loads(self.rec.FinalResult())["text"].split(' ')
-                # Find number in word sequence (ONLY works for single numeric sequence)
-                num_str = ""
-                is_positive = True
-                found_unknown = False
-                for word in words:
-                    if word in self.numbers:
-                        num_str = num_str + f" {word}"
-                    if word in ['minus', 'negative']:
-                        is_positive = False
-                    if word == "once":
-                        num_str = f" one"
-                    if word == "twice":
-                        num_str = f" two"
-                    if word == "thrice":
-                        num_str = f" three"
-                    if self.unknown_word == word:
-                        found_unknown = True
-                        break
-                if num_str != "":
-                    try:
-                        number = (2 * is_positive - 1) * w2n.word_to_num(num_str)
-                    except Exception:
-                        number = None
-                # Filter out instructions that contain unknown word
-                if found_unknown:
-                    words = []
-                    number = None
+                self.finals_sent += 1
                 self.vad.reset_states()
+                if self.streaming:
+                    speech = bytes(data)
+                else:
+                    self.utterance.write(data)
+                    speech = self.utterance.tobytes()
+                self.utterance.clear()
+                return speech, True
+        if not self.start_speech:
+            self.preroll.write(data)
+            return None
+        if self.streaming:
+            # Copy since data may be a view into a reused receive buffer
+            return bytes(data), False
+        self.utterance.write(data)
+        return None
 
-            def split_matches(list_a: Any, list_b: Any) -> Tuple[Any, Any]:
-                return [item for item in list_a if item not in list_b], [item for item in list_a if item in list_b]
+    def transcribe(self, speech, final=True):
+        """Decode audio, returns words, number and omitted words once the utterance is final"""
+        number = None
+        self.utterance_done = False
+        if self.endpoint_at == self.finals_received:
+            # Rest of an utterance that was already finalized early
+            if final:
+                self.finals_received += 1
+            return [], None, []
+        # Convert speech to text
+        if len(speech) > 0 and self.rec.AcceptWaveform(speech):
+            # Recognizer found an endpoint by itself
+            self.segments.append(json.loads(self.rec.Result())["text"])
+        if not final:
+            partial = " ".join(self.segments + [json.loads(self.rec.PartialResult())["partial"]]).strip()
+            self.partial_stable = self.partial_stable + 1 if partial == self.partial else 0
+            self.partial = partial
+            if not (self.early_endpoint and self.is_complete(partial)):
+                return [], None, []
+            # Grammar is closed, no need to wait for silence once a complete command has been heard
+            self.endpoint_at = self.finals_received
+        else:
+            self.finals_received += 1
+        self.segments.append(json.loads(self.rec.FinalResult())["text"])
+        words = " ".join(text for text in self.segments if text != "").split(' ')
+        self.segments = []
+        self.partial = ""
+        self.partial_stable = 0
+        self.utterance_done = True
+        # Find number in word sequence (ONLY works for single numeric sequence)
+        num_str = ""
+        is_positive = True
+        found_unknown = False
+        for word in words:
+            if word in self.numbers:
+                num_str = num_str + f" {word}"
+            if word in ['minus', 'negative']:
+                is_positive = False
+            if word == "once":
+                num_str = f" one"
+            if word == "twice":
+                num_str = f" two"
+            if word == "thrice":
+                num_str = f" three"
+            if self.unknown_word == word:
+                found_unknown = True
+                break
+        if num_str != "":
+            try:
+                number = (2 * is_positive - 1) * w2n.word_to_num(num_str)
+            except Exception:
+                number = None
+        # Filter out instructions that contain unknown word
+        if found_unknown:
+            words = []
+            number = None
 
-            # delete bulk from text
-            forbidden_words = ["time", "times"] + self.numbers
-            words, deleted = split_matches(words, forbidden_words)
+        def split_matches(list_a: Any, list_b: Any) -> Tuple[Any, Any]:
+            return [item for item in list_a if item not in list_b], [item for item in list_a if item in list_b]
+
+        # delete bulk from text
+        forbidden_words = ["time", "times"] + self.numbers
+        words, deleted = split_matches(words, forbidden_words)
 
         return words, number, deleted
+
+    def is_complete(self, text):
+        """Check if partial text is a complete command that can be finalized right away"""
+        guarded = self.partial_stable >= self.endpoint_guard
+        if text in self.complete_phrases:
+            return guarded or text not in self.guarded_phrases
+        for prefix in self.number_commands:
+            if text.startswith(prefix + ' '):
+                suffix = text[len(prefix) + 1:].split(' ')
+                # Number may still continue, e.g. "twenty" -> "twenty five"
+                return guarded and all(word in self.number_words for word in suffix)
+        return False
+
+
+class MultiSpeechRecognizer:
+    """Speech recognizer sessions keyed by client address, VAD of all active sessions runs as one batch"""
+
+    def __init__(self, model_path, sample_rate, chunk_size, streaming=False, session_timeout=60.0, vad=None,
+                 early_endpoint=False, endpoint_guard=0.3):
+        """Class Constructor. Sessions that have not sent audio in session_timeout seconds are dropped"""
+        self.model_path = model_path
+        self.rate = sample_rate
+        self.chunk_size = chunk_size
+        self.streaming = streaming
+        self.session_timeout = session_timeout
+        self.early_endpoint = early_endpoint
+        self.endpoint_guard = endpoint_guard
+        if vad is None:
+            vad = OnnxWrapper(str(Path(model_path, 'silero_vad.onnx')))
+        self.vad = vad
+        self.model = vosk.Model(model_path)
+        self.sessions = {}
+        self.last_seen = {}
+
+    def session(self, addr):
+        """Get recognizer of client, created on first use"""
+        rec = self.sessions.get(addr)
+        if rec is None:
+            rec = SpeechRecognizer(self.model_path, self.rate, self.chunk_size, self.streaming,
+                                   vad=VadStream(self.vad), model=self.model, early_endpoint=self.early_endpoint,
+                                   endpoint_guard=self.endpoint_guard)
+            self.sessions[addr] = rec
+        self.last_seen[addr] = time.monotonic()
+        return rec
+
+    def detect(self, items):
+        """Run VAD for a batch of (addr, data) items.
+
+        Chunks of different clients are stacked and run through the model at once, chunks of the same client are
+        processed in arrival order. Returns list of (addr, segment) of sessions that have audio to decode.
+        """
+        results = []
+        pending = list(items)
+        while len(pending) > 0:
+            tick = {}
+            rest = []
+            for addr, data in pending:
+                if addr in tick or len(data) != len(pending[0][1]):
+                    rest.append((addr, data))
+                else:
+                    tick[addr] = data
+            streams = [self.session(addr).vad for addr in tick]
+            x = np.stack([int2float(np.frombuffer(data, np.int16)) for data in tick.values()])
+            h = np.concatenate([stream.h for stream in streams], axis=1)
+            c = np.concatenate([stream.c for stream in streams], axis=1)
+            probs, h, c = self.vad.run_batch(x, h, c, self.rate)
+            for idx, (addr, data) in enumerate(tick.items()):
+                streams[idx].h = np.ascontiguousarray(h[:, idx:idx + 1])
+                streams[idx].c = np.ascontiguousarray(c[:, idx:idx + 1])
+                segment = self.sessions[addr].detect(data, probs[idx])
+                if segment is not None:
+                    results.append((addr, segment))
+            pending = rest
+        self.expire()
+        return results
+
+    def transcribe(self, addr, segment):
+        """Decode segment of a client"""
+        rec = self.sessions.get(addr)
+        if rec is None:
+            return [], None, []
+        return rec.transcribe(*segment)
+
+    def expire(self):
+        """Drop sessions of clients that have gone quiet"""
+        now = time.monotonic()
+        for addr in [addr for addr, seen in self.last_seen.items() if now - seen > self.session_timeout]:
+            del self.sessions[addr]
+            del self.last_seen[addr]
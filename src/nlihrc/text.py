@@ -1,29 +1,200 @@
-import sentence_transformers
 import numpy as np
+import toml
 
-from nlihrc.misc import Command
-from typing import Optional
-from scipy.spatial import distance
+from nlihrc.commandindex import CommandIndex, command_phrases
+from nlihrc.embedding import SentenceTransformerBackend, get_backend, load_or_encode, save_lite_table
+from nlihrc.misc import ASR_GRAMMAR, ASR_UNKNOWN_WORD, Command, LRUCache
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+
+def get_classifier(config):
+    """Create text classifier with the embedding backend from config"""
+    text_config = config.get('text', {})
+    exemplars = load_exemplars(text_config['exemplars']) if 'exemplars' in text_config else None
+    return TextClassifier(get_backend(config), text_config.get('cachesize', 1024),
+                          text_config.get('embeddingcache', None), exemplars, text_config.get('partitions', 0),
+                          text_config.get('nprobe', 4))
+
+
+def build_lite_table(config) -> int:
+    """Encode the speech recognizer vocabulary and command phrases with the [text] litesource backend and save
+    the table for the lite backend to [text] litetable. Returns the number of table entries."""
+    text_config = config.get('text', {})
+    source = dict(config, text=dict(text_config, backend=text_config.get('litesource', 'sentence_transformers')))
+    exemplars = load_exemplars(text_config['exemplars']) if 'exemplars' in text_config else None
+    phrases = [phrase for phrase in ASR_GRAMMAR if phrase != ASR_UNKNOWN_WORD]
+    phrases.extend(sentence for sentence, _ in command_phrases(exemplars))
+    return save_lite_table(get_backend(source), phrases, text_config['litetable'])
+
+
+def load_exemplars(path: str) -> List[Tuple[str, Command]]:
+    """Load paraphrases from a TOML file with a list of sentences per Command name"""
+    exemplars = []
+    for name, sentences in toml.load(path).items():
+        if name.upper() not in Command.__members__:
+            raise ValueError(f"Unknown command {name} in {path}")
+        exemplars.extend((sentence, Command[name.upper()]) for sentence in sentences)
+    return exemplars
+
+
+class Match(NamedTuple):
+    """Classification of one sentence"""
+    # Best command, None if its score is below threshold
+    command: Optional[Command]
+    score: float
+    # Score difference between the best and the second best command
+    margin: float
+    # Up to k (command, score) pairs from best to worst
+    candidates: List[Tuple[Command, float]]
+
+
+class CommandScorer:
+    """Cosine similarity of queries against a fixed set of embeddings with a single matmul"""
+
+    def __init__(self, embeddings: np.ndarray) -> None:
+        """Rows are normalized once, already unit length (e.g. memory-mapped) rows are used without copying"""
+        norms = np.linalg.norm(embeddings, axis=1)
+        if np.allclose(norms, 1.0, atol=1e-4):
+            self.matrix = embeddings
+        else:
+            self.matrix = (embeddings / np.maximum(norms, 1e-12)[:, None]).astype(np.float32)
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """Get (len(queries), rows) similarities"""
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        return (queries / np.maximum(norms, 1e-12)) @ self.matrix.T
+
+    @staticmethod
+    def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        """Get indices of the k best scores of a row from best to worst"""
+        k = min(k, len(scores))
+        if k < len(scores):
+            best = np.argpartition(-scores, k - 1)[:k]
+        else:
+            best = np.arange(len(scores))
+        return best[np.argsort(-scores[best])]
+
+
+class ExemplarIndex:
+    """Nearest exemplar search with scores aggregated per command (best exemplar of each command).
+
+    With partitions > 1 exemplars are clustered with k-means and a query is compared only against the exemplars
+    of the nprobe clusters closest to it, so the cost grows with the cluster sizes instead of the exemplar count.
+    Commands without an exemplar in the probed clusters score -1.
+    """
+
+    def __init__(self, embeddings: np.ndarray, labels: np.ndarray, num_labels: int, partitions: int = 0,
+                 nprobe: int = 4, iterations: int = 10) -> None:
+        """Rows of embeddings must be sorted by label and every label must have at least one row"""
+        self.scorer = CommandScorer(embeddings)
+        self.labels = np.asarray(labels)
+        self.num_labels = num_labels
+        self.starts = np.searchsorted(self.labels, np.arange(num_labels))
+        self.nprobe = nprobe
+        self.centroids: Optional[CommandScorer] = None
+        if partitions > 1 and len(self.labels) > 8 * partitions:
+            self.partition(partitions, iterations)
+
+    def partition(self, partitions: int, iterations: int) -> None:
+        """Cluster exemplars and store them sorted by cluster, each cluster is a contiguous slice"""
+        matrix = self.scorer.matrix
+        rng = np.random.default_rng(0)
+        centroids = np.array(matrix[rng.choice(len(matrix), partitions, replace=False)], dtype=np.float32)
+        for _ in range(iterations):
+            assign = np.argmax(matrix @ centroids.T, axis=1)
+            for cluster in range(partitions):
+                members = matrix[assign == cluster]
+                if len(members) > 0:
+                    centroid = members.sum(axis=0)
+                    centroids[cluster] = centroid / max(np.linalg.norm(centroid), 1e-12)
+        assign = np.argmax(matrix @ centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable')
+        self.centroids = CommandScorer(centroids)
+        self.bounds = np.searchsorted(assign[order], np.arange(partitions + 1))
+        self.sorted_matrix = np.ascontiguousarray(matrix[order])
+        self.sorted_labels = self.labels[order]
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """Get (len(queries), num_labels) similarities of the best exemplar per label"""
+        if self.centroids is None:
+            return np.maximum.reduceat(self.scorer.scores(queries), self.starts, axis=1)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        out = np.full((len(queries), self.num_labels), -1.0, dtype=np.float32)
+        for row, cluster_scores in enumerate(self.centroids.scores(queries)):
+            for cluster in CommandScorer.top_k(cluster_scores, self.nprobe):
+                start, end = self.bounds[cluster], self.bounds[cluster + 1]
+                np.maximum.at(out[row], self.sorted_labels[start:end], self.sorted_matrix[start:end] @ queries[row])
+        return out
 
 
 class TextClassifier:
 
-    def __init__(self) -> None:
+    def __init__(self, backend=None, cache_size: int = 1024, cache_dir: Optional[str] = None,
+                 exemplars: Optional[Sequence[Tuple[str, Command]]] = None, partitions: int = 0,
+                 nprobe: int = 4) -> None:
+        """Backend provides encode(sentences) -> (len(sentences), dim) array, defaults to sentence_transformers.
+
+        Every command is represented by its name, its CLIPORT phrase and the given (sentence, command) exemplars.
+        Exemplar embeddings are persisted in cache_dir if given. See ExemplarIndex for partitions and nprobe.
+        """
 
-        self.model = sentence_transformers.SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        self.backend = backend if backend is not None else SentenceTransformerBackend()
 
-        commands_sentences = [member.name.lower().replace('_', ' ') for member in Command]
+        self.commands = list(Command)
 
-        self.command_embeddings = self.model.encode(commands_sentences, convert_to_tensor=False)
+        phrases = command_phrases(exemplars)
+        labels = np.array([self.commands.index(cmd) for _, cmd in phrases])
+
+        self.command_embeddings = load_or_encode(self.backend, [sentence for sentence, _ in phrases], cache_dir)
+
+        self.scorer = ExemplarIndex(self.command_embeddings, labels, len(self.commands), partitions, nprobe)
+
+        # In-grammar sentences and exemplars are looked up without running the model
+        self.index = CommandIndex(exemplars)
+
+        # Recognized vocabulary is closed so the same sentences repeat, keep similarities to every command
+        self.cache = LRUCache(cache_size)
+
+    @staticmethod
+    def normalize(sentence: str) -> str:
+        """Normalize case and whitespace, model output does not depend on either"""
+        return " ".join(sentence.lower().split())
 
     def find_match(self, input_sentence: str, threshold: float) -> Optional[Command]:
 
-        inp_embedding = self.model.encode(input_sentence, convert_to_tensor=False).reshape(1, -1)
+        return self.find_matches([input_sentence], 1, threshold)[0].command
+
+    def find_matches(self, sentences: Sequence[str], k: int = 1, threshold: float = 0.0) -> List[Match]:
+        """Classify sentences, all sentences that need the model are encoded in one batch"""
+        matches: List[Optional[Match]] = [None] * len(sentences)
+        rows: List[Optional[np.ndarray]] = [None] * len(sentences)
+        pending = {}
+        for idx, sentence in enumerate(sentences):
+            cmd = self.index.lookup(sentence)
+            if cmd is not None:
+                matches[idx] = Match(cmd, 1.0, 1.0, [(cmd, 1.0)])
+                continue
+            key = self.normalize(sentence)
+            rows[idx] = self.cache.get(key)
+            if rows[idx] is None:
+                pending.setdefault(key, []).append(idx)
 
-        sim = (1 - distance.cdist(inp_embedding, self.command_embeddings, 'cosine')).flatten()
+        if len(pending) > 0:
+            keys = list(pending)
+            for key, row in zip(keys, self.scorer.scores(self.backend.encode(keys))):
+                self.cache.put(key, row)
+                for idx in pending[key]:
+                    rows[idx] = row
 
-        maxidx = np.argmax(sim)
+        for idx, row in enumerate(rows):
+            if row is not None:
+                matches[idx] = self.match(row, k, threshold)
+        return matches
 
-        if sim[maxidx] < threshold:
-            return None
-        return Command(maxidx)
+    def match(self, row: np.ndarray, k: int, threshold: float) -> Match:
+        """Get match from similarities to every command"""
+        best = CommandScorer.top_k(row, max(k, 2))
+        score = float(row[best[0]])
+        margin = score - float(row[best[1]]) if len(best) > 1 else score
+        candidates = [(self.commands[i], float(row[i])) for i in best[:k]]
+        return Match(self.commands[best[0]] if score >= threshold else None, score, margin, candidates)
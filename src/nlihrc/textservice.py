@@ -0,0 +1,134 @@
+"""Text classification service that micro-batches queued requests"""
+import itertools
+import json
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+def parse_request(data: str) -> Tuple[Optional[str], str]:
+    """Get (id, text) from a JSON object with id and text, or plain text without an id"""
+    if data.startswith('{'):
+        try:
+            request = json.loads(data)
+        except ValueError:
+            return None, data
+        if isinstance(request, dict) and 'text' in request:
+            request_id = request.get('id')
+            return (None if request_id is None else str(request_id)), str(request['text'])
+    return None, data
+
+
+class TextService(threading.Thread):
+    """Worker that classifies queued requests and passes a reply dict per request to publish.
+
+    Requests that arrive within batch_window seconds of the first queued one are classified together, so the
+    model runs once per batch. Replies carry the request id and the time spent queued, classifying and in total.
+    If classification or publishing fails every request of the batch that has no reply yet gets an error reply and
+    the error is passed to on_error. Requests without a client id get ids auto-0, auto-1, ...
+    """
+
+    def __init__(self, classifier, publish: Callable[[Dict[str, Any]], None], threshold: float,
+                 queue_size: int = 64, batch_window: float = 0.005, max_batch: int = 32,
+                 on_error: Optional[Callable[[str, Exception], None]] = None) -> None:
+        """Initialize service, classifier provides find_matches(sentences, k, threshold)"""
+        threading.Thread.__init__(self, daemon=True)
+        self.q: "queue.Queue[Tuple[str, str, float]]" = queue.Queue(maxsize=queue_size)
+        self.close_thread = False
+        self.classifier = classifier
+        self.publish = publish
+        self.threshold = threshold
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.on_error = on_error
+        self.ids = itertools.count()
+        # Replies of the current batch that have been published
+        self.published = 0
+        self.handled = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+
+    def submit(self, text: str, request_id: Optional[str] = None) -> str:
+        """Queue request and get its id, a full queue is answered with an error reply right away"""
+        if request_id is None:
+            request_id = f"auto-{next(self.ids)}"
+        received = time.monotonic()
+        try:
+            self.q.put_nowait((request_id, text, received))
+        except queue.Full:
+            self.rejected += 1
+            self.publish({"id": request_id, "text": text, "command": None, "error": "queue full",
+                          "latency_ms": 1000 * (time.monotonic() - received)})
+        return request_id
+
+    def collect(self) -> List[Tuple[str, str, float]]:
+        """Block for the first request, then gather the requests arriving within the batch window"""
+        try:
+            batch = [self.q.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.q.get(timeout=remaining) if remaining > 0 else self.q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def handle(self, batch: List[Tuple[str, str, float]]) -> None:
+        """Classify batch with one find_matches call and publish replies"""
+        self.published = 0
+        started = time.monotonic()
+        matches = self.classifier.find_matches([text for _, text, _ in batch], 1, self.threshold)
+        finished = time.monotonic()
+        self.batches += 1
+        replies = [
+            {
+                "id": request_id,
+                "text": text,
+                "command": None if match.command is None else match.command.name,
+                "value": None if match.command is None else match.command.value,
+                "score": match.score,
+                "margin": match.margin,
+                "batch": len(batch),
+                "queue_ms": 1000 * (started - received),
+                "classify_ms": 1000 * (finished - started),
+            }
+            for (request_id, text, received), match in zip(batch, matches)
+        ]
+        for reply, (_, _, received) in zip(replies, batch):
+            reply["latency_ms"] = 1000 * (time.monotonic() - received)
+            self.publish(reply)
+            self.published += 1
+            self.handled += 1
+
+    def run(self) -> None:
+        """Thread run function"""
+        while not self.close_thread:
+            batch = self.collect()
+            if len(batch) == 0:
+                continue
+            try:
+                self.handle(batch)
+            except Exception as e:  # pylint: disable=W0703
+                self.fail(batch[self.published:], e)
+
+    def fail(self, batch: List[Tuple[str, str, float]], error: Exception) -> None:
+        """Answer every request of a failed batch that has no reply yet with an error reply"""
+        self.failed += len(batch)
+        if self.on_error is not None:
+            self.on_error("text", error)
+        for request_id, text, received in batch:
+            self.publish({"id": request_id, "text": text, "command": None, "error": repr(error),
+                          "latency_ms": 1000 * (time.monotonic() - received)})
+
+    def stop(self) -> None:
+        """Signal thread to exit"""
+        self.close_thread = True
+
+    def stats(self) -> Dict[str, int]:
+        """Get request counters"""
+        return {"handled": self.handled, "rejected": self.rejected, "failed": self.failed, "batches": self.batches}
@@ -1,6 +1,13 @@
 import threading
 import socket
+import select
+import struct
 import queue
+import time
+
+# Optional datagram header: big-endian uint32 sequence number in front of the audio payload
+SEQ_HEADER = struct.Struct('>I')
+SEQ_MASK = 0xFFFFFFFF
 
 
 def get_ip():
@@ -18,13 +25,14 @@ def get_ip():
 
 class UDPReceiver (threading.Thread):
     """Handles UDP socket receiving logic"""
-    def __init__(self, buffersize, ip, port):
-        """Initialize configuration"""
+    def __init__(self, buffersize, ip, port, queue_size=0, with_address=False):
+        """Initialize configuration. With with_address queue items are (sender address, data) tuples"""
         threading.Thread.__init__(self)
         
-        self.q = queue.Queue()
+        self.q = queue.Queue(maxsize=queue_size)
         self.close_thread = False
         self.bs = buffersize
+        self.with_address = with_address
         self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp.settimeout(3)
         self.udp.bind((ip, port))
@@ -34,11 +42,213 @@ class UDPReceiver (threading.Thread):
         """Thread run function handles receiving datagram and putting in queue"""
         while not self.close_thread:
             try:
-                data, _ = self.udp.recvfrom(self.bs)
+                data, addr = self.udp.recvfrom(self.bs)
             except socket.timeout:
                 continue
             if 'data' in locals():
-                self.q.put(data)
+                self.put(addr, data)
                 del data
         
         self.udp.close()
+
+    def put(self, addr, data):
+        """Put datagram to queue"""
+        if self.with_address:
+            data = (addr, data)
+        # Block while consumer is behind, socket buffer absorbs (and eventually drops) datagrams meanwhile
+        while not self.close_thread:
+            try:
+                self.q.put(data, timeout=0.5)
+                break
+            except queue.Full:
+                continue
+
+    def stop(self):
+        """Signal thread to exit"""
+        self.close_thread = True
+
+
+class PacketPool:
+    """Preallocated datagram buffers that are handed out round robin"""
+    def __init__(self, count, size):
+        self.buffer = bytearray(count * size)
+        view = memoryview(self.buffer)
+        self.slots = [view[idx * size:(idx + 1) * size] for idx in range(count)]
+        self.idx = 0
+
+    def slot(self):
+        """Get current free slot"""
+        return self.slots[self.idx]
+
+    def advance(self):
+        """Mark current slot as used, it gets reused after all other slots"""
+        self.idx = (self.idx + 1) % len(self.slots)
+
+
+class JitterBuffer:
+    """Reorders sequence numbered packets. A missing packet is counted as lost once depth later packets wait"""
+    def __init__(self, depth):
+        self.depth = depth
+        self.expected = None
+        self.held = {}
+        self.late_run = 0
+        self.lost = 0
+        self.late = 0
+        self.reordered = 0
+
+    def push(self, seq, packet):
+        """Add packet, returns packets that are ready in sequence order or None if packet was dropped"""
+        if self.expected is None:
+            self.expected = seq
+        diff = (seq - self.expected) & SEQ_MASK
+        if diff > SEQ_MASK // 2 or seq in self.held:
+            # Too late or duplicate
+            self.late += 1
+            self.late_run += 1
+            if self.late_run > self.depth:
+                # Sender has most likely restarted its sequence
+                ready = self.flush()
+                self.expected = seq
+                return ready + self.push(seq, packet)
+            return None
+        self.late_run = 0
+        ready = []
+        if diff > self.depth:
+            # Far ahead, give up on everything before it
+            ready = self.flush()
+            self.lost += (seq - self.expected) & SEQ_MASK
+            self.expected = seq
+        self.held[seq] = packet
+        if seq != self.expected:
+            self.reordered += 1
+        self.release(ready)
+        if len(self.held) > self.depth:
+            self.skip()
+            self.release(ready)
+        return ready
+
+    def release(self, ready):
+        """Move consecutive packets starting from expected to ready"""
+        while self.expected in self.held:
+            ready.append(self.held.pop(self.expected))
+            self.expected = (self.expected + 1) & SEQ_MASK
+
+    def skip(self):
+        """Skip missing packets up to the oldest held packet"""
+        nxt = min(self.held, key=lambda seq: (seq - self.expected) & SEQ_MASK)
+        self.lost += (nxt - self.expected) & SEQ_MASK
+        self.expected = nxt
+
+    def flush(self):
+        """Get all held packets in sequence order"""
+        ready = []
+        while len(self.held) > 0:
+            self.skip()
+            self.release(ready)
+        return ready
+
+
+class PooledUDPReceiver(UDPReceiver):
+    """UDP receiver that drains the socket with recv_into into a preallocated packet pool.
+
+    Queue items are memoryviews into the pool. The pool has room for everything that can be queued or taken by
+    consumer batches, so consumers must copy a packet before taking more than that.
+    With seq_header datagrams start with a sequence number and are reordered per sender. Packets held by a jitter
+    buffer are copied out of the pool, so any number of senders can wait for late packets at once. Jitter buffers
+    of senders that have not sent anything in sender_timeout seconds are dropped.
+    """
+    def __init__(self, buffersize, ip, port, queue_size, with_address=False, seq_header=False, jitter_depth=4,
+                 pool_size=None, sender_timeout=60.0):
+        """Initialize configuration"""
+        if queue_size <= 0:
+            raise ValueError("Packet pool needs a bounded queue")
+        UDPReceiver.__init__(self, buffersize, ip, port, queue_size, with_address)
+        self.udp.setblocking(False)
+        # Wakes select up on stop so shutdown does not wait for a timeout
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.seq_header = seq_header
+        self.jitter_depth = jitter_depth
+        self.jitters = {}
+        self.sender_timeout = sender_timeout
+        self.last_seen = {}
+        self.last_expire = time.monotonic()
+        # Counters of expired jitter buffers
+        self.expired = {"lost": 0, "late": 0, "reordered": 0}
+        self.received = 0
+        header_size = SEQ_HEADER.size if seq_header else 0
+        if pool_size is None:
+            pool_size = queue_size + 2
+        self.pool = PacketPool(pool_size, buffersize + header_size)
+
+    def run(self):
+        """Thread run function waits for datagrams and drains all that have arrived"""
+        while not self.close_thread:
+            readable, _, _ = select.select([self.udp, self.wake_r], [], [])
+            if self.wake_r in readable:
+                break
+            while not self.close_thread:
+                view = self.pool.slot()
+                try:
+                    nbytes, addr = self.udp.recvfrom_into(view)
+                except BlockingIOError:
+                    break
+                self.received += 1
+                for packet in self.unpack(view[:nbytes], addr):
+                    self.put(addr, packet)
+
+        self.udp.close()
+        self.wake_r.close()
+        self.wake_w.close()
+
+    def unpack(self, data, addr):
+        """Get payloads that are ready for the consumer, advances pool if datagram is kept"""
+        if not self.seq_header:
+            self.pool.advance()
+            return [data]
+        if len(data) < SEQ_HEADER.size:
+            return []
+        seq, = SEQ_HEADER.unpack_from(data)
+        now = time.monotonic()
+        if now - self.last_expire > 1.0:
+            self.expire(now)
+        jitter = self.jitters.get(addr)
+        if jitter is None:
+            jitter = JitterBuffer(self.jitter_depth)
+            self.jitters[addr] = jitter
+        self.last_seen[addr] = now
+        payload = data[SEQ_HEADER.size:]
+        ready = jitter.push(seq, payload)
+        if ready is None:
+            return []
+        if seq in jitter.held:
+            # Held packet waits for an unknown time, its slot is reused for the next datagram
+            jitter.held[seq] = bytes(payload)
+        else:
+            self.pool.advance()
+        return ready
+
+    def expire(self, now=None):
+        """Drop jitter buffers of senders that have gone quiet, their held packets are counted as lost"""
+        now = time.monotonic() if now is None else now
+        self.last_expire = now
+        for addr in [addr for addr, seen in self.last_seen.items() if now - seen > self.sender_timeout]:
+            jitter = self.jitters.pop(addr)
+            del self.last_seen[addr]
+            self.expired["lost"] += jitter.lost + len(jitter.held)
+            self.expired["late"] += jitter.late
+            self.expired["reordered"] += jitter.reordered
+
+    def stop(self):
+        """Signal thread to exit"""
+        self.close_thread = True
+        self.wake_w.send(b'\0')
+
+    def stats(self):
+        """Get received, lost, late and reordered packet counts"""
+        return {
+            "received": self.received,
+            "lost": self.expired["lost"] + sum(jitter.lost for jitter in self.jitters.values()),
+            "late": self.expired["late"] + sum(jitter.late for jitter in self.jitters.values()),
+            "reordered": self.expired["reordered"] + sum(jitter.reordered for jitter in self.jitters.values()),
+            "senders": len(self.jitters),
+        }
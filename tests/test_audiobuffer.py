@@ -0,0 +1,43 @@
+"""Tests for audio buffers"""
+from nlihrc.audiobuffer import RingBuffer, UtteranceBuffer
+
+
+def test_ringbuffer_keeps_latest() -> None:
+    """Ring buffer returns only the newest bytes in order"""
+    ring = RingBuffer(6)
+    out = UtteranceBuffer(2)
+    for chunk in [b"ab", b"cd", b"ef", b"gh"]:
+        ring.write(chunk)
+    ring.read_into(out)
+    assert out.tobytes() == b"cdefgh"
+    assert len(ring) == 6
+
+
+def test_ringbuffer_partial_and_oversized() -> None:
+    """Partially filled and oversized writes"""
+    ring = RingBuffer(4)
+    out = UtteranceBuffer(1)
+    ring.write(b"abc")
+    ring.read_into(out)
+    assert out.tobytes() == b"abc"
+    ring.write(b"0123456")
+    out.clear()
+    ring.read_into(out)
+    assert out.tobytes() == b"3456"
+    ring.clear()
+    out.clear()
+    ring.read_into(out)
+    assert len(out) == 0
+
+
+def test_utterancebuffer_grows_and_reuses() -> None:
+    """Utterance buffer grows on demand and keeps allocation after clear"""
+    buf = UtteranceBuffer(4)
+    for _ in range(10):
+        buf.write(b"xyz")
+    assert buf.tobytes() == b"xyz" * 10
+    size = len(buf.buffer)
+    buf.clear()
+    buf.write(b"q")
+    assert buf.view().tobytes() == b"q"
+    assert len(buf.buffer) == size
@@ -0,0 +1,150 @@
+"""Test CLIPORT client reply matching"""
+import importlib
+import json
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+from nlihrc.misc import Command
+from nlihrc.scheduler import CommandScheduler
+
+
+class FakeString:
+    """std_msgs String double"""
+
+    def __init__(self, data: str = "") -> None:
+        self.data = data
+
+
+class FakePublisher:
+    """Publisher double that records messages and calls on_publish"""
+
+    def __init__(self, topic, msg_type, queue_size=None) -> None:
+        self.messages = []
+        self.on_publish = None
+
+    def publish(self, msg) -> None:
+        """Record message"""
+        self.messages.append(msg)
+        if self.on_publish is not None:
+            self.on_publish(msg)
+
+
+@pytest.fixture(name="client")
+def fixture_client(monkeypatch: pytest.MonkeyPatch):
+    """CLIPORT client without request ids on stubbed ROS topics"""
+    rospy = types.ModuleType("rospy")
+    rospy.Publisher = FakePublisher
+    rospy.Subscriber = lambda topic, msg_type, callback: None
+    rospy.loginfo = rospy.logwarn = lambda msg: None
+    msg = types.ModuleType("std_msgs.msg")
+    msg.String = FakeString
+    monkeypatch.setitem(sys.modules, "rospy", rospy)
+    monkeypatch.setitem(sys.modules, "std_msgs", types.ModuleType("std_msgs"))
+    monkeypatch.setitem(sys.modules, "std_msgs.msg", msg)
+    monkeypatch.delitem(sys.modules, "nlihrc.cliport_client", raising=False)
+    return importlib.import_module("nlihrc.cliport_client").CliportClient()
+
+
+def reply(client, data) -> None:
+    """Deliver reply to the subscriber callback"""
+    client.sub_callback(FakeString(json.dumps(data)))
+
+
+def reply_on_publish(client, *replies) -> None:
+    """Send replies from another thread once the next request has been published"""
+    def on_publish(_):
+        client.pub.on_publish = None
+        threading.Thread(target=lambda: [reply(client, data) for data in replies]).start()
+
+    client.pub.on_publish = on_publish
+
+
+def test_reply_is_returned(client) -> None:
+    """Reply to the waiting request is returned, replies while no request waits are dropped"""
+    reply(client, {"pick_xyz": [0, 0, 0]})
+    reply_on_publish(client, {"pick_xyz": [1, 2, 3]})
+    assert client.request("put bolt in brown box", 5.0) == {"pick_xyz": [1, 2, 3]}
+    assert client.pub.messages == ["put bolt in brown box"]
+    assert client.pending_id is None
+    client.sub_callback(FakeString("{broken"))
+    stats = client.stats()
+    assert (stats["requests"], stats["stale"], stats["timeouts"]) == (1, 2, 0)
+
+
+def test_late_reply_is_not_taken_by_next_request(client) -> None:
+    """First reply after a timed out request is its late reply, not the answer to the next request"""
+    assert client.request("put bolt in brown box", 0.01) is None
+    reply_on_publish(client, {"late": True}, {"late": False})
+    assert client.request("put bolt in red box", 5.0) == {"late": False}
+
+    # Reply arriving while idle is the late one as well
+    assert client.request("put bolt in brown box", 0.01) is None
+    reply(client, {"late": True})
+    reply_on_publish(client, {"late": False})
+    assert client.request("put bolt in red box", 5.0) == {"late": False}
+    stats = client.stats()
+    assert (stats["requests"], stats["stale"], stats["timeouts"]) == (4, 2, 2)
+
+
+def test_lost_reply_costs_one_request(client) -> None:
+    """If a timed out request never gets its reply, only the next request loses its reply"""
+    assert client.request("put bolt in brown box", 0.01) is None
+    reply_on_publish(client, {"reply": 2})
+    assert client.request("put bolt in red box", 0.2) is None
+    reply_on_publish(client, {"reply": 3})
+    assert client.request("put bolt in red box", 5.0) == {"reply": 3}
+
+
+def test_wake_ends_cancelled_request(client) -> None:
+    """Cancel and wake from another thread end a waiting request right away"""
+    cancel = threading.Event()
+    results = []
+    waiting = threading.Event()
+    client.pub.on_publish = lambda msg: waiting.set()
+    thread = threading.Thread(target=lambda: results.append(client.request("put bolt in brown box", 30.0, cancel)))
+    start = time.monotonic()
+    thread.start()
+    assert waiting.wait(5.0)
+    cancel.set()
+    client.wake()
+    thread.join(5.0)
+    assert not thread.is_alive()
+    assert time.monotonic() - start < 5.0
+    assert results == [None]
+    assert client.pending_id is None
+    stats = client.stats()
+    assert (stats["cancelled"], stats["timeouts"]) == (1, 0)
+
+
+def test_stop_wakes_command_waiting_for_poses(client) -> None:
+    """Stop during a pose request ends the wait right away and the command does not move the arm afterwards"""
+    moves = []
+    waiting = threading.Event()
+    stopped = threading.Event()
+    client.pub.on_publish = lambda msg: waiting.set()
+
+    def runner(cmd, number):
+        if cmd == Command.STOP_EXECUTION:
+            stopped.set()
+            return
+        client.request("put bolt in brown box", 30.0, scheduler.cancel)
+        if scheduler.cancel.is_set():
+            return
+        moves.append("home")
+
+    scheduler = CommandScheduler(runner, client.wake)
+    scheduler.start()
+    scheduler.submit(Command.PUT_BOLT_IN_BROWN_BOX)
+    assert waiting.wait(5.0)
+    scheduler.submit(Command.STOP_EXECUTION)
+    assert stopped.wait(5.0)
+    scheduler.stop()
+    scheduler.join()
+    assert moves == []
+    assert client.pending_id is None
+    assert client.stats()["cancelled"] == 1
+    assert scheduler.stats()["preempted"] == 1
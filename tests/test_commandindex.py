@@ -0,0 +1,15 @@
+"""Test exact match command index"""
+from nlihrc.commandindex import CommandIndex
+from nlihrc.misc import Command
+
+
+def test_index_matches_in_grammar_sentences() -> None:
+    """Command names, synonyms and CLIPORT phrases resolve without the model"""
+    index = CommandIndex()
+    assert index.lookup("move up") == Command.MOVE_UP
+    assert index.lookup("  Move  forward ") == Command.MOVE_FRONT
+    assert index.lookup("open the gripper") == Command.OPEN_TOOL
+    assert index.lookup("put bolt in brown box") == Command.PUT_BOLT_IN_BROWN_BOX
+    assert index.lookup("put cap in brown box") == Command.PUT_ROCKER_ARM_IN_BROWN_BOX
+    assert index.lookup("move robot somewhere") is None
+    assert (index.hits, index.misses) == (5, 1)
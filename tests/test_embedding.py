@@ -0,0 +1,98 @@
+"""Test embedding backends"""
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from nlihrc.embedding import LiteBackend, OnnxBackend, WordPieceTokenizer, get_backend, load_or_encode, save_lite_table
+
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "move", "up", "rot", "##ate", ","]
+
+
+def write_vocab(path: Path) -> None:
+    """Write tiny vocab file"""
+    path.write_text("\n".join(VOCAB) + "\n", encoding="utf-8")
+
+
+def test_wordpiece_tokenizer(tmp_path: Path) -> None:
+    """Words are split into sub-words, unknown words map to [UNK] and batches are padded"""
+    write_vocab(tmp_path / "vocab.txt")
+    tokenizer = WordPieceTokenizer(str(tmp_path / "vocab.txt"))
+    assert tokenizer.encode("Rotate, MOVE") == [2, 6, 7, 8, 4, 3]
+    input_ids, attention_mask = tokenizer(["move up", "jump"])
+    assert input_ids.tolist() == [[2, 4, 5, 3], [2, 1, 3, 0]]
+    assert attention_mask.tolist() == [[1, 1, 1, 1], [1, 1, 1, 0]]
+
+
+def test_onnx_backend_mean_pools(tmp_path: Path) -> None:
+    """Token embeddings are averaged over the attention mask and normalized"""
+    onnx = pytest.importorskip("onnx")
+    from onnx import helper, TensorProto  # pylint: disable=C0415
+
+    write_vocab(tmp_path / "vocab.txt")
+    table = np.zeros((len(VOCAB), 2), dtype=np.float32)
+    table[4] = [3.0, 0.0]
+    table[5] = [0.0, 3.0]
+    graph = helper.make_graph(
+        [helper.make_node("Gather", ["table", "input_ids"], ["last_hidden_state"])],
+        "embed",
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "length"])],
+        [helper.make_tensor_value_info("last_hidden_state", TensorProto.FLOAT, ["batch", "length", 2])],
+        [onnx.numpy_helper.from_array(table, "table")],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, str(tmp_path / "model.onnx"))
+
+    backend = OnnxBackend(str(tmp_path), "model.onnx")
+    embeddings = backend.encode(["move up", "move"])
+    assert embeddings.shape == (2, 2)
+    np.testing.assert_allclose(embeddings, [[np.sqrt(0.5), np.sqrt(0.5)], [1.0, 0.0]], atol=1e-6)
+
+
+class CountingBackend:
+    """Backend double that counts encoded sentences"""
+
+    def __init__(self, model_id: str) -> None:
+        self.model_id = model_id
+        self.encoded = 0
+
+    def encode(self, sentences):
+        """Embed sentence by its length"""
+        self.encoded += len(sentences)
+        return np.array([[len(sentence), 1.0] for sentence in sentences], dtype=np.float32)
+
+
+def test_load_or_encode_persists(tmp_path: Path) -> None:
+    """Embeddings are encoded once per model and sentence list and memory-mapped afterwards"""
+    backend = CountingBackend("a")
+    first = load_or_encode(backend, ["move up", "home"], str(tmp_path))
+    second = load_or_encode(backend, ["move up", "home"], str(tmp_path))
+    assert backend.encoded == 2
+    assert isinstance(second, np.memmap)
+    np.testing.assert_array_equal(first, second)
+    load_or_encode(backend, ["move up"], str(tmp_path))
+    load_or_encode(CountingBackend("b"), ["move up", "home"], str(tmp_path))
+    assert backend.encoded == 3
+    assert len(list(tmp_path.glob("*.npy"))) == 3
+
+
+def test_lite_backend_pools_table(tmp_path: Path) -> None:
+    """Table holds words and bigrams of the phrases, sentences pool the entries they contain"""
+    path = str(tmp_path / "lite.npz")
+    assert save_lite_table(CountingBackend("a"), ["move up", "up"], path) == 3
+    backend = LiteBackend(path)
+    assert backend.vectors.dtype == np.float16
+    embeddings = backend.encode(["Move up", "jump"])
+    # move (4, 1), up (2, 1) and "move up" (7, 1) averaged
+    expected = np.array([13 / 3, 1.0])
+    np.testing.assert_allclose(embeddings[0], expected / np.linalg.norm(expected), atol=1e-3)
+    assert not embeddings[1].any()
+
+
+def test_missing_model_files_are_reported(tmp_path: Path) -> None:
+    """Backends without their exported model or table fail with a hint on how to create it"""
+    with pytest.raises(FileNotFoundError, match="README"):
+        get_backend({"text": {"backend": "onnx", "modelpath": str(tmp_path)}})
+    with pytest.raises(FileNotFoundError, match="distill"):
+        get_backend({"text": {"backend": "lite", "litetable": str(tmp_path / "table.npz")}})
@@ -0,0 +1,36 @@
+"""Import time guards for the CLI entrypoints"""
+import subprocess
+import sys
+from typing import Dict
+
+import pytest
+
+MODEL_STACKS = ["torch", "sentence_transformers", "vosk", "onnxruntime", "sounddevice", "moveit_commander"]
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """Import module in a fresh interpreter, returns cumulative import time in microseconds per imported module"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_console_import_is_light() -> None:
+    """CLI module must not load ROS or any model stack"""
+    times = import_times("nlihrc.console")
+    assert not set(times) & set(MODEL_STACKS + ["rospy", "nlihrc.main"])
+    assert times["nlihrc.console"] < 1_000_000
+
+
+def test_main_import_skips_model_stacks() -> None:
+    """Entrypoint module only imports ROS, model stacks are loaded by the nodes that use them"""
+    pytest.importorskip("rospy")
+    times = import_times("nlihrc.main")
+    assert not set(times) & set(MODEL_STACKS)
@@ -0,0 +1,45 @@
+"""Test utility functions"""
+from types import SimpleNamespace
+
+from nlihrc.misc import LRUCache, PlanCache
+
+
+def test_lru_cache_evicts_least_recently_used() -> None:
+    """Getting an entry protects it from eviction, counters follow lookups"""
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats() == {"hits": 3, "misses": 1, "size": 2}
+
+
+def test_lru_cache_disabled() -> None:
+    """Zero size stores nothing"""
+    cache = LRUCache(0)
+    cache.put("a", 1)
+    assert len(cache) == 0
+    assert cache.get("a") is None
+
+
+def trajectory(names, start):
+    """RobotTrajectory like object starting at start"""
+    return SimpleNamespace(joint_trajectory=SimpleNamespace(joint_names=names,
+                                                            points=[SimpleNamespace(positions=start)]))
+
+
+def test_plan_cache_checks_start_state() -> None:
+    """Cached plan is returned near the start it was planned from and dropped if the start has drifted"""
+    cache = PlanCache(4, resolution=0.01)
+    names = ["j1", "j2"]
+    plan = trajectory(names, [0.1, 0.2])
+    cache.put([0.1, 0.2], [1.0, 1.0], plan)
+    assert cache.get(names, [0.101, 0.2], [1.0, 1.0]) is plan
+    assert cache.get(names, [0.1, 0.2], [1.0, 0.5]) is None
+    # Quantizes to the same key but the first point is too far from the actual start
+    cache.put([0.1, 0.2], [1.0, 1.0], trajectory(names, [0.1, 0.23]))
+    assert cache.get(names, [0.1, 0.2], [1.0, 1.0]) is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "size": 0, "invalid": 1}
@@ -0,0 +1,74 @@
+"""Tests for staged pipeline"""
+import queue
+import threading
+
+from nlihrc.pipeline import Pipeline
+
+
+def test_stages_forward_and_close() -> None:
+    """Items flow through all stages in order and close drains the pipeline"""
+    source: "queue.Queue[int]" = queue.Queue()
+    results = []
+    pipeline = Pipeline(source, queue_size=2)
+    pipeline.add_stage("double", lambda x: x * 2).add_stage("odd", lambda x: None if x % 4 else x)
+    pipeline.add_stage("sink", results.append)
+    pipeline.start()
+    for i in range(10):
+        source.put(i)
+    pipeline.close()
+    pipeline.wait()
+    assert results == [0, 4, 8, 12, 16]
+    assert pipeline.stats()["double"]["processed"] == 10
+    assert not pipeline.is_alive()
+
+
+def test_stage_error_does_not_stop_pipeline() -> None:
+    """Handler exceptions are reported and the stage keeps running"""
+    source: "queue.Queue[int]" = queue.Queue()
+    errors = []
+    results = []
+    pipeline = Pipeline(source, on_error=lambda name, e: errors.append(name))
+    pipeline.add_stage("invert", lambda x: 1 / x).add_stage("sink", results.append)
+    pipeline.start()
+    for i in [1, 0, 2]:
+        source.put(i)
+    pipeline.close()
+    pipeline.wait()
+    assert errors == ["invert"]
+    assert results == [1.0, 0.5]
+
+
+def test_stop_with_blocked_stage() -> None:
+    """Stop signal ends stages even when downstream is full"""
+    source: "queue.Queue[int]" = queue.Queue()
+    release = threading.Event()
+    pipeline = Pipeline(source, queue_size=1, timeout=0.05)
+    pipeline.add_stage("pass", lambda x: x).add_stage("slow", lambda x: release.wait())
+    pipeline.start()
+    for i in range(5):
+        source.put(i)
+    pipeline.stop()
+    release.set()
+    pipeline.wait()
+    assert not pipeline.is_alive()
+
+
+def test_batch_stage() -> None:
+    """Batch stage gets queued items as one list and forwards every result"""
+    source: "queue.Queue[int]" = queue.Queue()
+    batches = []
+    results = []
+
+    def handle(batch):  # type: ignore
+        batches.append(len(batch))
+        return [x + 1 for x in batch]
+
+    for i in range(5):
+        source.put(i)
+    pipeline = Pipeline(source)
+    pipeline.add_stage("batch", handle, batch_size=4).add_stage("sink", results.append)
+    pipeline.start()
+    pipeline.close()
+    pipeline.wait()
+    assert results == [1, 2, 3, 4, 5]
+    assert batches == [4, 1]
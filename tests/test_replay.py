@@ -0,0 +1,68 @@
+"""Tests for offline replay"""
+import wave
+from pathlib import Path
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+
+from nlihrc.replay import ReplayReceiver, read_chunks, run_benchmark
+
+
+class LoudnessRecognizer:
+    """Recognizer double that treats non-zero chunks as speech and ends an utterance on first silent chunk"""
+
+    def __init__(self) -> None:
+        self.silent_chunks = 0
+        self.voiced = 0
+        self.utterance_done = False
+
+    def detect(self, data: bytes) -> Optional[Tuple[bytes, bool]]:
+        """Voiced if any sample is non-zero"""
+        if np.frombuffer(data, np.int16).any():
+            self.voiced += 1
+            self.silent_chunks = 0
+            return None
+        if self.voiced == 0:
+            return None
+        self.silent_chunks = 1
+        return b"", True
+
+    def transcribe(self, speech: bytes, final: bool = True) -> Tuple[List[str], Optional[int], List[str]]:
+        """Report number of voiced chunks"""
+        self.utterance_done = final
+        voiced, self.voiced = self.voiced, 0
+        return ["chunks"], voiced, []
+
+
+def write_wav(path: Path, samples: Any) -> None:
+    """Write 16 kHz mono test file"""
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes(samples.astype(np.int16).tobytes())
+
+
+def test_read_chunks_pads_last(tmp_path: Path) -> None:
+    """WAV and raw files are read in equal sized frames"""
+    samples = np.arange(10)
+    write_wav(tmp_path / "a.wav", samples)
+    (tmp_path / "a.raw").write_bytes(samples.astype(np.int16).tobytes())
+    for name in ["a.wav", "a.raw"]:
+        chunks = list(read_chunks(tmp_path / name, 4, 16000))
+        assert [len(chunk) for chunk in chunks] == [8, 8, 8]
+        assert np.frombuffer(chunks[-1], np.int16).tolist() == [8, 9, 0, 0]
+
+
+def test_benchmark_reports_utterances(tmp_path: Path) -> None:
+    """Utterance at the end of file is finalized by trailing silence"""
+    write_wav(tmp_path / "speech.wav", np.concatenate([np.zeros(1600), np.full(3200, 1000)]))
+    source = ReplayReceiver([tmp_path / "speech.wav"], 1600, 16000, realtime=False, trailing_silence=0.2)
+    texts = []
+    source.start()
+    results = run_benchmark(LoudnessRecognizer(), source, lambda words, number, deleted: texts.append(number))
+    assert texts == [2]
+    assert results["chunks"] == 5
+    assert results["utterances"] == 1
+    assert abs(results["audio_s"] - 0.5) < 1e-9
+    assert results["latency_ms_mean"] >= 100.0
@@ -0,0 +1,98 @@
+"""Test robot command scheduler"""
+import threading
+
+from nlihrc.misc import Command
+from nlihrc.scheduler import CommandQueue, CommandScheduler
+
+
+def test_stop_preempts_running_and_queued_commands() -> None:
+    """Stop cancels the running command, skips commands queued before it and runs next"""
+    started = threading.Event()
+    finished = threading.Event()
+    ran = []
+    statuses = []
+
+    def runner(cmd, number):
+        ran.append((cmd, number))
+        if cmd == Command.PUT_BOLT_IN_BROWN_BOX:
+            started.set()
+            assert scheduler.cancel.wait(5.0)
+        if cmd == Command.MOVE_UP:
+            finished.set()
+
+    preempts = []
+    scheduler = CommandScheduler(runner, lambda: preempts.append(True), statuses.append)
+    scheduler.start()
+    scheduler.submit(Command.PUT_BOLT_IN_BROWN_BOX)
+    assert started.wait(5.0)
+    scheduler.submit(Command.MOVE_DOWN)
+    scheduler.submit(Command.STOP_EXECUTION)
+    scheduler.submit(Command.MOVE_UP, 3)
+    assert finished.wait(5.0)
+    scheduler.stop()
+    scheduler.join()
+    assert ran == [(Command.PUT_BOLT_IN_BROWN_BOX, None), (Command.STOP_EXECUTION, None), (Command.MOVE_UP, 3)]
+    assert preempts == [True]
+    assert scheduler.stats() == {"preempted": 1, "skipped": 1, "queued": 0, "dropped": 0, "coalesced": 0,
+                                 "overflows": 0}
+    assert ("preempted", "PUT_BOLT_IN_BROWN_BOX") in [(status["state"], status["command"]) for status in statuses]
+    assert not scheduler.cancel.is_set()
+
+
+def test_failed_command_is_reported() -> None:
+    """Runner errors go to the error callback and the worker keeps running"""
+    errors = []
+    done = threading.Event()
+
+    def runner(cmd, number):
+        if cmd == Command.HOME:
+            raise RuntimeError("no plan")
+        done.set()
+
+    scheduler = CommandScheduler(runner, on_error=lambda name, e: errors.append(name))
+    scheduler.start()
+    scheduler.submit(Command.HOME)
+    scheduler.submit(Command.MOVE_UP)
+    assert done.wait(5.0)
+    scheduler.stop()
+    scheduler.join()
+    assert errors == ["HOME"]
+
+
+def test_queue_coalesces_jogs_and_keeps_protected_commands() -> None:
+    """Consecutive jogs collapse to the newest, overflow drops the oldest unprotected command"""
+    continuous = [True]
+    commands = CommandQueue(3, lambda mode: continuous[0] if mode is None else mode == Command.SET_MODE_CONTINUOUS)
+    commands.put(Command.MOVE_UP)
+    _, removed = commands.put(Command.MOVE_LEFT)
+    assert removed == [("coalesced", 0, Command.MOVE_UP)]
+    commands.put(Command.OPEN_TOOL)
+    commands.put(Command.SET_MODE_STEP)
+    _, removed = commands.put(Command.SAVE_POSITION, 2)
+    assert removed == [("dropped", 1, Command.MOVE_LEFT)]
+    _, removed = commands.put(Command.CLOSE_TOOL)
+    assert removed == [("dropped", 4, Command.SAVE_POSITION)]
+    # Nothing left to drop, urgent command goes over the bound
+    _, removed = commands.put(Command.STOP_EXECUTION, urgent=True)
+    assert removed == []
+    continuous[0] = False
+    commands.put(Command.MOVE_UP)
+    commands.put(Command.MOVE_UP)
+    order = [commands.get(0)[1] for _ in range(commands.qsize())]
+    assert order == [Command.STOP_EXECUTION, Command.OPEN_TOOL, Command.SET_MODE_STEP, Command.CLOSE_TOOL]
+    assert commands.stats() == {"queued": 0, "dropped": 4, "coalesced": 1, "overflows": 1}
+
+    # Robot is in continuous mode but the queued jogs will run in step mode
+    continuous[0] = True
+    commands = CommandQueue(0, lambda mode: continuous[0] if mode is None else mode == Command.SET_MODE_CONTINUOUS)
+    commands.put(Command.SET_MODE_STEP)
+    commands.put(Command.MOVE_UP)
+    _, removed = commands.put(Command.MOVE_DOWN)
+    assert removed == []
+    commands.put(Command.SET_MODE_CONTINUOUS)
+    commands.put(Command.MOVE_LEFT)
+    _, removed = commands.put(Command.MOVE_RIGHT)
+    assert [(state, cmd) for state, _, cmd in removed] == [("coalesced", Command.MOVE_LEFT)]
+    order = [commands.get(0)[1] for _ in range(commands.qsize())]
+    assert order == [Command.SET_MODE_STEP, Command.MOVE_UP, Command.MOVE_DOWN, Command.SET_MODE_CONTINUOUS,
+                     Command.MOVE_RIGHT]
@@ -0,0 +1,225 @@
+"""Test voice activity detection and speech recognizer state handling"""
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from nlihrc import speech
+from nlihrc.speech import IOBindingVad, MultiSpeechRecognizer, OnnxWrapper, SpeechRecognizer
+
+CHUNK = 512
+VOICED = np.full(CHUNK, 1000, dtype=np.int16)
+SILENT = np.zeros(CHUNK, dtype=np.int16)
+# Chunks of silence that end an utterance, see SpeechRecognizer.chunk_offset
+HANGOVER = 33
+
+
+class FakeKaldiRecognizer:
+    """Recognizer double, the test sets the partial text and the final result is the last partial"""
+
+    def __init__(self, model, rate, grammar) -> None:
+        self.partial = ""
+        self.audio = b""
+
+    def AcceptWaveform(self, data) -> bool:  # pylint: disable=C0103
+        self.audio += bytes(data)
+        return False
+
+    def PartialResult(self) -> str:  # pylint: disable=C0103
+        return json.dumps({"partial": self.partial})
+
+    def FinalResult(self) -> str:  # pylint: disable=C0103
+        text, self.partial = self.partial, ""
+        return json.dumps({"text": text})
+
+
+@pytest.fixture(name="vad_path")
+def fixture_vad_path(tmp_path: Path) -> str:
+    """Tiny model with the silero VAD interface: speech probability is the mean absolute sample, hn = h0 + 1"""
+    onnx = pytest.importorskip("onnx")
+    from onnx import helper, TensorProto  # pylint: disable=C0415
+
+    graph = helper.make_graph(
+        [
+            helper.make_node("Abs", ["input"], ["magnitude"]),
+            helper.make_node("ReduceMean", ["magnitude"], ["prob"], axes=[1], keepdims=1),
+            helper.make_node("Sub", ["one", "prob"], ["silence"]),
+            helper.make_node("Concat", ["silence", "prob"], ["output"], axis=1),
+            helper.make_node("Add", ["h0", "one"], ["hn"]),
+            helper.make_node("Identity", ["c0"], ["cn"]),
+        ],
+        "vad",
+        [
+            helper.make_tensor_value_info("input", TensorProto.FLOAT, ["batch", "samples"]),
+            helper.make_tensor_value_info("h0", TensorProto.FLOAT, [2, "batch", 64]),
+            helper.make_tensor_value_info("c0", TensorProto.FLOAT, [2, "batch", 64]),
+        ],
+        [
+            helper.make_tensor_value_info("output", TensorProto.FLOAT, ["batch", 2]),
+            helper.make_tensor_value_info("hn", TensorProto.FLOAT, [2, "batch", 64]),
+            helper.make_tensor_value_info("cn", TensorProto.FLOAT, [2, "batch", 64]),
+        ],
+        [onnx.numpy_helper.from_array(np.array(1.0, dtype=np.float32), "one")],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)])
+    model.ir_version = 8
+    onnx.save(model, str(tmp_path / "silero_vad.onnx"))
+    return str(tmp_path / "silero_vad.onnx")
+
+
+@pytest.fixture(name="fake_vosk")
+def fixture_fake_vosk(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Replace vosk model and recognizer"""
+    monkeypatch.setattr(speech.vosk, "Model", lambda path: object())
+    monkeypatch.setattr(speech.vosk, "KaldiRecognizer", FakeKaldiRecognizer)
+
+
+def make_recognizer(vad_path: str, streaming: bool, early_endpoint: bool = False) -> SpeechRecognizer:
+    """Recognizer with the tiny VAD, complete commands that may continue wait for 2 stable partials"""
+    return SpeechRecognizer(str(Path(vad_path).parent), 16000, CHUNK, streaming, OnnxWrapper(vad_path),
+                            model=object(), early_endpoint=early_endpoint, endpoint_guard=0.064)
+
+
+def test_run_batch_times_every_chunk(vad_path: str) -> None:
+    """Batched runs are counted per chunk so the mean VAD time is comparable to single stream runs"""
+    vad = OnnxWrapper(vad_path)
+    x = np.stack([np.ones(CHUNK, dtype=np.float32), np.zeros(CHUNK, dtype=np.float32)])
+    states = np.zeros((2, 2, 64), dtype=np.float32)
+    probs, h, _ = vad.run_batch(x, states, states, 16000)
+    np.testing.assert_allclose(probs, [1.0, 0.0])
+    assert np.all(h == 1.0)
+    assert vad.calls == 2
+    assert vad.speech_prob(VOICED, 16000) == pytest.approx(1.0)
+    assert vad.calls == 3
+    assert vad.elapsed > 0
+    with pytest.raises(ValueError):
+        vad.run_batch(x, states[:, :1], states[:, :1], 16000)
+
+
+def test_iobinding_vad_matches_float_path(vad_path: str) -> None:
+    """IOBinding VAD keeps its state across chunks and also accepts float chunks like OnnxWrapper"""
+    vad = OnnxWrapper(vad_path)
+    bound = IOBindingVad(vad_path)
+    for chunk in [VOICED, SILENT, VOICED]:
+        assert bound.speech_prob(chunk, 16000) == pytest.approx(vad.speech_prob(chunk, 16000))
+    assert np.all(bound.h[bound.state_idx] == 3.0)
+    assert bound.calls == 3
+
+    prob = bound(np.ones(CHUNK, dtype=np.float32), 16000)
+    assert prob == pytest.approx(1.0)
+    assert np.all(bound.h[bound.state_idx] == 4.0)
+    assert bound.speech_prob(SILENT, 16000) == pytest.approx(0.0)
+    assert np.all(bound.h[bound.state_idx] == 5.0)
+
+    bound.reset_states()
+    assert bound.speech_prob(VOICED, 16000) == pytest.approx(1.0)
+    assert np.all(bound.h[bound.state_idx] == 1.0)
+
+
+@pytest.mark.usefixtures("fake_vosk")
+def test_streaming_detect_returns_voiced_chunks(vad_path: str) -> None:
+    """Streaming mode decodes the pre-roll and every voiced chunk right away and finalizes after the hangover"""
+    rec = make_recognizer(vad_path, streaming=True)
+    for _ in range(3):
+        assert rec.detect(SILENT.tobytes()) is None
+    first = rec.detect(VOICED.tobytes())
+    assert first == (SILENT.tobytes() * 3 + VOICED.tobytes(), False)
+    assert rec.detect(VOICED.tobytes()) == (VOICED.tobytes(), False)
+    rec.rec.partial = "move up"
+    assert rec.transcribe(*first) == ([], None, [])
+    assert rec.partial == "move up"
+    for _ in range(HANGOVER - 1):
+        assert rec.detect(SILENT.tobytes()) == (SILENT.tobytes(), False)
+    assert rec.detect(SILENT.tobytes()) == (SILENT.tobytes(), True)
+    assert rec.transcribe(SILENT.tobytes(), True) == (["move", "up"], None, [])
+    assert rec.utterance_done
+    assert rec.partial == ""
+    assert rec.finals_sent == rec.finals_received == 1
+
+
+@pytest.mark.usefixtures("fake_vosk")
+def test_buffered_detect_returns_whole_utterance(vad_path: str) -> None:
+    """Without streaming the utterance is returned once, including pre-roll and hangover"""
+    rec = make_recognizer(vad_path, streaming=False)
+    chunks = [SILENT] * 2 + [VOICED] * 2 + [SILENT] * HANGOVER
+    segments = [rec.detect(chunk.tobytes()) for chunk in chunks]
+    assert segments[:-1] == [None] * (len(chunks) - 1)
+    assert segments[-1] == (b"".join(chunk.tobytes() for chunk in chunks), True)
+    rec.rec.partial = "rotate tool minus twenty"
+    assert rec.transcribe(*segments[-1]) == (["rotate", "tool", "minus"], -20, ["twenty"])
+    assert rec.rec.audio == segments[-1][0]
+
+
+@pytest.mark.usefixtures("fake_vosk")
+def test_early_endpoint_handshake(vad_path: str) -> None:
+    """A complete command ends the utterance before the hangover, its tail is dropped by both stages"""
+    rec = make_recognizer(vad_path, streaming=True, early_endpoint=True)
+    segment = rec.detect(VOICED.tobytes())
+    # VAD stage runs ahead of the ASR stage
+    late = rec.detect(VOICED.tobytes())
+    rec.rec.partial = "open tool"
+    assert rec.transcribe(*segment) == (["open", "tool"], None, [])
+    assert rec.endpoint_at == 0
+    assert rec.utterance_done
+    # Chunks detected before the VAD stage noticed the endpoint are skipped
+    assert rec.transcribe(*late) == ([], None, [])
+    assert not rec.utterance_done
+    assert rec.finals_received == 0
+
+    # VAD stage ends the utterance and ignores the rest of the speech
+    assert rec.detect(VOICED.tobytes()) == (b"", True)
+    assert rec.draining
+    assert rec.finals_sent == 1
+    assert rec.detect(VOICED.tobytes()) is None
+    assert rec.transcribe(b"", True) == ([], None, [])
+    assert rec.finals_received == 1
+    assert rec.detect(SILENT.tobytes()) is None
+    assert not rec.draining
+
+    # Next utterance is decoded normally
+    segment = rec.detect(VOICED.tobytes())
+    assert segment == (SILENT.tobytes() + VOICED.tobytes(), False)
+    rec.rec.partial = "move"
+    assert rec.transcribe(*segment) == ([], None, [])
+    assert rec.endpoint_at == 0
+
+
+@pytest.mark.usefixtures("fake_vosk")
+def test_early_endpoint_guard_waits_for_numbers(vad_path: str) -> None:
+    """Commands with a number are finalized only once the partial text has been stable for the guard"""
+    rec = make_recognizer(vad_path, streaming=True, early_endpoint=True)
+    assert not rec.is_complete("step size")
+    assert not rec.is_complete("step size five meters")
+    segment = rec.detect(VOICED.tobytes())
+    rec.rec.partial = "step size"
+    assert rec.transcribe(*segment) == ([], None, [])
+    rec.rec.partial = "step size five"
+    assert rec.transcribe(VOICED.tobytes(), False) == ([], None, [])
+    assert rec.transcribe(VOICED.tobytes(), False) == ([], None, [])
+    assert rec.partial_stable == 1
+    assert rec.transcribe(VOICED.tobytes(), False) == (["step", "size"], 5, ["five"])
+    assert rec.endpoint_at == 0
+
+
+@pytest.mark.usefixtures("fake_vosk")
+def test_multi_detect_batches_sessions(vad_path: str) -> None:
+    """Chunks of different clients share a VAD run, chunks of one client keep their order and own state"""
+    vad = OnnxWrapper(vad_path)
+    multi = MultiSpeechRecognizer(str(Path(vad_path).parent), 16000, CHUNK, streaming=True, vad=vad)
+    client_a, client_b = ("10.0.0.1", 1), ("10.0.0.2", 2)
+    results = multi.detect([(client_a, VOICED.tobytes()), (client_b, SILENT.tobytes()),
+                            (client_a, VOICED.tobytes())])
+    assert results == [(client_a, (VOICED.tobytes(), False)), (client_a, (VOICED.tobytes(), False))]
+    assert vad.calls == 3
+    assert np.all(multi.sessions[client_a].vad.h == 2.0)
+    assert np.all(multi.sessions[client_b].vad.h == 1.0)
+    assert multi.sessions[client_a].vad.h.flags["C_CONTIGUOUS"]
+
+    multi.sessions[client_a].rec.partial = "move up"
+    assert multi.transcribe(client_a, results[0][1]) == ([], None, [])
+    assert multi.transcribe(("10.0.0.3", 3), (b"", True)) == ([], None, [])
+
+    multi.last_seen[client_b] -= 120
+    multi.expire()
+    assert list(multi.sessions) == [client_a]
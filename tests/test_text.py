@@ -0,0 +1,81 @@
+"""Test text classifier"""
+import numpy as np
+import pytest
+
+from nlihrc.misc import Command
+from nlihrc.text import CommandScorer, ExemplarIndex, TextClassifier, load_exemplars
+
+
+class BagOfWordsBackend:
+    """Backend double embedding sentences as word counts"""
+
+    def __init__(self) -> None:
+        self.model_id = "bow"
+        self.words = sorted({word for member in Command for word in member.name.lower().split('_')} | {"lift"})
+        self.calls = 0
+
+    def encode(self, sentences):
+        """Count known words"""
+        self.calls += 1
+        out = np.zeros((len(sentences), len(self.words)), dtype=np.float32)
+        for row, sentence in enumerate(sentences):
+            for word in sentence.split():
+                if word == "lift":
+                    word = "up"
+                if word in self.words:
+                    out[row, self.words.index(word)] += 1
+        return out
+
+
+def test_scorer_top_k() -> None:
+    """Scores are cosine similarities and top k is ordered"""
+    scorer = CommandScorer(np.array([[2.0, 0.0], [1.0, 1.0], [0.0, 3.0]]))
+    scores = scorer.scores(np.array([[1.0, 0.0]]))[0]
+    np.testing.assert_allclose(scores, [1.0, np.sqrt(0.5), 0.0], atol=1e-6)
+    assert CommandScorer.top_k(scores, 2).tolist() == [0, 1]
+
+
+def test_find_matches_batches_and_caches() -> None:
+    """Index hits skip the model, the rest are encoded in one call and cached"""
+    backend = BagOfWordsBackend()
+    classifier = TextClassifier(backend)
+    assert backend.calls == 1
+    matches = classifier.find_matches(["move up", "move lift", "lift", "move lift"], k=3, threshold=0.5)
+    assert backend.calls == 2
+    assert matches[0].command == Command.MOVE_UP and matches[0].score == 1.0
+    assert matches[1].command == Command.MOVE_UP
+    assert len(matches[1].candidates) == 3
+    assert matches[1].margin > 0
+    assert matches[3] == matches[1]
+    assert matches[2].candidates[0][0] == Command.MOVE_UP
+    assert classifier.find_match("move lift", 0.5) == Command.MOVE_UP
+    assert classifier.find_match("move lift", 1.1) is None
+    assert backend.calls == 2
+
+
+def test_exemplar_index_partitions_match_full_search() -> None:
+    """Probing every partition gives the same per label maxima as searching all exemplars"""
+    rng = np.random.default_rng(1)
+    labels = np.sort(rng.integers(0, 5, 200))
+    labels[:5] = np.arange(5)
+    labels = np.sort(labels)
+    embeddings = rng.normal(size=(200, 8)).astype(np.float32)
+    queries = rng.normal(size=(3, 8)).astype(np.float32)
+    full = ExemplarIndex(embeddings, labels, 5)
+    partitioned = ExemplarIndex(embeddings, labels, 5, partitions=4, nprobe=4)
+    assert partitioned.centroids is not None
+    np.testing.assert_allclose(partitioned.scores(queries), full.scores(queries), atol=1e-5)
+    assert full.scores(queries).shape == (3, 5)
+
+
+def test_exemplars_are_matched(tmp_path) -> None:
+    """Exemplars from file resolve exactly and lend their embedding to the command"""
+    path = tmp_path / "exemplars.toml"
+    path.write_text('move_up = ["lift it"]\n', encoding="utf-8")
+    backend = BagOfWordsBackend()
+    classifier = TextClassifier(backend, exemplars=load_exemplars(str(path)))
+    assert classifier.find_match("lift it", 0.9) == Command.MOVE_UP
+    assert classifier.find_match("lift it now", 0.5) == Command.MOVE_UP
+    path.write_text('fly = ["take off"]\n', encoding="utf-8")
+    with pytest.raises(ValueError):
+        load_exemplars(str(path))
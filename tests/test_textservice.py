@@ -0,0 +1,125 @@
+"""Test text classification service"""
+import threading
+
+from nlihrc.misc import Command
+from nlihrc.text import Match
+from nlihrc.textservice import TextService, parse_request
+
+
+class RecordingClassifier:
+    """Classifier double that records batches"""
+
+    def __init__(self) -> None:
+        self.batches = []
+
+    def find_matches(self, sentences, k, threshold):
+        """Everything is MOVE_UP"""
+        self.batches.append(list(sentences))
+        return [Match(Command.MOVE_UP, 0.9, 0.2, [(Command.MOVE_UP, 0.9)]) for _ in sentences]
+
+
+def test_parse_request() -> None:
+    """JSON requests carry an id, plain text does not"""
+    assert parse_request('{"id": 7, "text": "move up"}') == ("7", "move up")
+    assert parse_request("move up") == (None, "move up")
+    assert parse_request("{broken") == (None, "{broken")
+
+
+def test_requests_are_batched_and_answered() -> None:
+    """Requests queued together are classified in one call and every one gets a reply"""
+    classifier = RecordingClassifier()
+    replies = []
+    done = threading.Event()
+
+    def publish(reply):
+        replies.append(reply)
+        if len(replies) == 3:
+            done.set()
+
+    service = TextService(classifier, publish, 0.7, batch_window=0.05)
+    ids = [service.submit("move up", "a"), service.submit("lift"), service.submit("go up")]
+    service.start()
+    assert done.wait(5.0)
+    service.stop()
+    service.join()
+    assert classifier.batches == [["move up", "lift", "go up"]]
+    assert [reply["id"] for reply in replies] == ids == ["a", "auto-0", "auto-1"]
+    assert replies[0]["command"] == "MOVE_UP" and replies[0]["batch"] == 3
+    assert all(reply["latency_ms"] >= reply["queue_ms"] >= 0 for reply in replies)
+
+
+def test_full_queue_is_answered() -> None:
+    """Requests that do not fit the queue get an error reply instead of being dropped"""
+    replies = []
+    service = TextService(RecordingClassifier(), replies.append, 0.7, queue_size=1)
+    service.submit("move up")
+    service.submit("move down")
+    assert replies[0]["error"] == "queue full"
+    assert service.stats()["rejected"] == 1
+
+
+class FailingClassifier(RecordingClassifier):
+    """Classifier double that fails on the first batch"""
+
+    def find_matches(self, sentences, k, threshold):
+        """First call raises"""
+        if len(self.batches) == 0:
+            self.batches.append(list(sentences))
+            raise RuntimeError("model failed")
+        return super().find_matches(sentences, k, threshold)
+
+
+def test_failed_batch_is_answered_and_service_keeps_running() -> None:
+    """A classifier error is reported, every request of the batch gets an error reply and later requests work"""
+    replies = []
+    errors = []
+    received = threading.Semaphore(0)
+
+    def publish(reply):
+        replies.append(reply)
+        received.release()
+
+    service = TextService(FailingClassifier(), publish, 0.7, batch_window=0.05,
+                          on_error=lambda name, e: errors.append((name, e)))
+    service.submit("move up", "a")
+    service.submit("lift", "b")
+    service.start()
+    for _ in range(2):
+        assert received.acquire(timeout=5.0)
+    service.submit("go up", "c")
+    assert received.acquire(timeout=5.0)
+    service.stop()
+    service.join()
+    assert [reply["id"] for reply in replies] == ["a", "b", "c"]
+    assert all("model failed" in reply["error"] and reply["command"] is None for reply in replies[:2])
+    assert replies[2]["command"] == "MOVE_UP"
+    assert [name for name, _ in errors] == ["text"]
+    assert service.stats()["failed"] == 2
+
+
+def test_publish_error_answers_only_unanswered_requests() -> None:
+    """If publishing fails partway through a batch, only requests without a reply get an error reply"""
+    replies = []
+    errors = []
+    done = threading.Event()
+
+    def publish(reply):
+        if reply["id"] == "b" and "error" not in reply:
+            raise RuntimeError("publish failed")
+        replies.append(reply)
+        if len(replies) == 3:
+            done.set()
+
+    service = TextService(RecordingClassifier(), publish, 0.7, batch_window=0.05,
+                          on_error=lambda name, e: errors.append((name, e)))
+    for request_id, text in [("a", "move up"), ("b", "lift"), ("c", "go up")]:
+        service.submit(text, request_id)
+    service.start()
+    assert done.wait(5.0)
+    service.stop()
+    service.join()
+    assert [reply["id"] for reply in replies] == ["a", "b", "c"]
+    assert replies[0]["command"] == "MOVE_UP"
+    assert all("publish failed" in reply["error"] for reply in replies[1:])
+    assert [name for name, _ in errors] == ["text"]
+    assert service.stats()["handled"] == 1 and service.stats()["failed"] == 2
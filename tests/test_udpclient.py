@@ -0,0 +1,92 @@
+"""Tests for UDP intake"""
+import socket
+
+from nlihrc.udpclient import SEQ_HEADER, JitterBuffer, PooledUDPReceiver
+
+
+def test_jitter_in_order_and_reordered() -> None:
+    """Late packets are put back in order"""
+    jitter = JitterBuffer(depth=3)
+    assert jitter.push(10, b"a") == [b"a"]
+    assert jitter.push(12, b"c") == []
+    assert jitter.push(11, b"b") == [b"b", b"c"]
+    assert jitter.reordered == 1
+    assert jitter.lost == 0
+
+
+def test_jitter_loss_and_late() -> None:
+    """Missing packet is skipped once depth packets wait, arriving afterwards it is too late"""
+    jitter = JitterBuffer(depth=2)
+    jitter.push(0, b"0")
+    assert jitter.push(2, b"2") == []
+    assert jitter.push(3, b"3") == []
+    assert jitter.push(4, b"4") == [b"2", b"3", b"4"]
+    assert jitter.lost == 1
+    assert jitter.push(1, b"1") is None
+    assert jitter.late == 1
+
+
+def test_jitter_wraparound_and_restart() -> None:
+    """Sequence numbers wrap around and a restarted sender is followed"""
+    jitter = JitterBuffer(depth=1)
+    assert jitter.push(0xFFFFFFFF, b"x") == [b"x"]
+    assert jitter.push(0, b"y") == [b"y"]
+    assert jitter.push(5, b"far") == [b"far"]
+    assert jitter.lost == 4
+    assert jitter.push(0, b"old") is None
+    assert jitter.push(1, b"restart") == [b"restart"]
+    assert jitter.push(2, b"new") == [b"new"]
+
+
+def test_pooled_receiver_reorders() -> None:
+    """Datagrams with sequence header arrive in order and stop is immediate"""
+    receiver = PooledUDPReceiver(8, "127.0.0.1", 0, queue_size=8, seq_header=True, jitter_depth=2)
+    port = receiver.udp.getsockname()[1]
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.start()
+    try:
+        for seq in [0, 2, 1, 3]:
+            sender.sendto(SEQ_HEADER.pack(seq) + bytes([seq]) * 4, ("127.0.0.1", port))
+        packets = [bytes(receiver.q.get(timeout=2)) for _ in range(4)]
+    finally:
+        receiver.stop()
+        receiver.join(2)
+        sender.close()
+    assert packets == [bytes([seq]) * 4 for seq in range(4)]
+    assert not receiver.is_alive()
+    assert receiver.stats()["received"] == 4
+
+
+def receive(receiver: PooledUDPReceiver, addr, seq: int, payload: bytes):
+    """Write datagram into the current pool slot like recvfrom_into and unpack it"""
+    view = receiver.pool.slot()
+    datagram = SEQ_HEADER.pack(seq) + payload
+    view[:len(datagram)] = datagram
+    return [bytes(packet) for packet in receiver.unpack(view[:len(datagram)], addr)]
+
+
+def test_pooled_receiver_holds_packets_of_many_senders() -> None:
+    """Packets held for several senders at once do not overwrite each other in the small pool"""
+    receiver = PooledUDPReceiver(4, "127.0.0.1", 0, queue_size=2, seq_header=True, jitter_depth=4, pool_size=4)
+    senders = {name: ("127.0.0.1", port) for name, port in [("A", 1), ("B", 2), ("C", 3)]}
+    try:
+        for name, addr in senders.items():
+            assert receive(receiver, addr, 0, name.encode() * 4) == [name.encode() * 4]
+        for seq in [2, 3]:
+            for name, addr in senders.items():
+                assert receive(receiver, addr, seq, f"{name}{seq}{seq}{seq}".encode()) == []
+        assert receive(receiver, senders["A"], 1, b"A111") == [b"A111", b"A222", b"A333"]
+        assert receive(receiver, senders["C"], 1, b"C111") == [b"C111", b"C222", b"C333"]
+        assert receiver.stats()["senders"] == 3
+
+        # B never sends its missing packet and goes quiet
+        receiver.last_seen[senders["B"]] -= 120
+        receiver.expire()
+        stats = receiver.stats()
+        assert stats["senders"] == 2
+        assert stats["lost"] == 2
+        assert stats["reordered"] == 6
+    finally:
+        receiver.udp.close()
+        receiver.wake_r.close()
+        receiver.wake_w.close()